@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the playlist manipulator on synthetic libraries and playlists.
+
+Run with --help for the parameters. The results are printed, or saved with
+-output, as JSON, so that they can be compared between commits.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import random
+import struct
+import argparse
+import platform
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+
+import mutagen.id3
+import mutagen.flac
+
+import playlist_manipulator
+
+# MPEG 1 Layer III, 128 kbps, 44100 Hz, no padding, stereo
+MP3_FRAME_HEADER = b'\xff\xfb\x90\x64'
+MP3_FRAME_SIZE = 417
+
+def write_mp3(fn, artist, title, frames=40):
+    """ Writes an MP3 file of silent frames, tagged with ID3v2"""
+    frame = MP3_FRAME_HEADER + bytes(MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))
+    with open(fn, 'wb') as f:
+        f.write(frame * frames)
+    tags = mutagen.id3.ID3()
+    tags.add(mutagen.id3.TPE1(encoding=3, text=[artist]))
+    tags.add(mutagen.id3.TIT2(encoding=3, text=[title]))
+    tags.save(fn)
+
+def write_flac(fn, artist, title, seconds=30):
+    """ Writes a FLAC file without audio frames, tagged with Vorbis comments"""
+    sample_rate = 44100
+    channels = 2
+    bits = 16
+    samples = sample_rate * seconds
+    streaminfo = struct.pack('>HH', 4096, 4096) + bytes(6)
+    # 20 bits sample rate, 3 bits channels-1, 5 bits bits-1, 36 bits samples
+    streaminfo += ((sample_rate << 44) | ((channels - 1) << 41)
+                   | ((bits - 1) << 36) | samples).to_bytes(8, 'big')
+    streaminfo += bytes(16)
+    with open(fn, 'wb') as f:
+        f.write(b'fLaC' + bytes([0x80]) + len(streaminfo).to_bytes(3, 'big')
+                + streaminfo)
+    meta = mutagen.flac.FLAC(fn)
+    meta['artist'] = artist
+    meta['title'] = title
+    meta.save()
+
+def _atom(name, payload):
+    return struct.pack('>I', 8 + len(payload)) + name + payload
+
+def write_m4a(fn, artist, title, seconds=30):
+    """
+    Writes an MP4 audio file without samples, with the atoms needed for its
+    length and an ilst with the tags. Empty tags are left out
+    """
+    timescale = 44100
+    mdhd = _atom(b'mdhd', bytes(12) + struct.pack('>2I', timescale,
+                                                 timescale * seconds)
+                 + bytes(4))
+    hdlr = _atom(b'hdlr', bytes(8) + b'soun' + bytes(13))
+    items = b''
+    for name, value in [(b'\xa9ART', artist), (b'\xa9nam', title)]:
+        if value:
+            # Type 1 is UTF-8 text, followed by an empty locale
+            items += _atom(name, _atom(b'data', struct.pack('>2I', 1, 0)
+                                       + value.encode('utf-8')))
+    meta = _atom(b'meta', bytes(4)
+                 + _atom(b'hdlr', bytes(8) + b'mdirappl' + bytes(9))
+                 + _atom(b'ilst', items))
+    moov = _atom(b'moov', _atom(b'trak', _atom(b'mdia', mdhd + hdlr))
+                 + _atom(b'udta', meta))
+    with open(fn, 'wb') as f:
+        f.write(_atom(b'ftyp', b'M4A ' + bytes(4) + b'M4A isom') + moov)
+
+def generate_library(root, depth=2, fanout=4, files=8,
+                     extensions=('mp3', 'flac'), seed=0):
+    """
+    Creates a folder tree of tagged songs
+
+    Parameters
+    ----------
+    root : str, path
+        The folder to create the library in
+    depth : int, optional
+        Levels of subfolders below root. The default is 2.
+    fanout : int, optional
+        Subfolders per folder. The default is 4.
+    files : int, optional
+        Songs per folder. The default is 8.
+    extensions : tuple of str, optional
+        Formats of the songs, used in turn. The default is ('mp3', 'flac').
+    seed : int, optional
+        Seed of the random names. The default is 0.
+
+    Returns
+    -------
+    count : int
+        The number of songs created
+
+    """
+    rng = random.Random(seed)
+    count = 0
+    folders = [(root, 0)]
+    while folders:
+        folder, level = folders.pop()
+        os.makedirs(folder, exist_ok=True)
+        artist = 'Artist {}'.format(rng.randint(1, 1000))
+        for i in range(files):
+            extension = extensions[count % len(extensions)]
+            title = 'Song {} {}'.format(i + 1, rng.randint(1, 10**6))
+            fn = os.path.join(folder, '{:02d} {}.{}'.format(i + 1, title,
+                                                            extension))
+            if extension == 'flac':
+                write_flac(fn, artist, title)
+            else:
+                write_mp3(fn, artist, title)
+            count += 1
+        if level < depth:
+            for i in range(fanout):
+                folders.append((os.path.join(folder, 'Album {}'.format(i + 1)),
+                                level + 1))
+    return count
+
+def generate_playlist(fn, groups=100, entries=100, seed=0):
+    """
+    Writes a merged playlist of groups with entries each, without reading
+    any song. Returns the number of lines written
+    """
+    rng = random.Random(seed)
+    lines = 1
+    with open(fn, 'w', encoding='utf-8') as f:
+        f.write('#EXTM3U\n')
+        for g in range(groups):
+            f.write('#EXTGRP:Group {}\n'.format(g + 1))
+            for e in range(entries):
+                title = 'Song {}'.format(rng.randint(1, 10**6))
+                f.write('#EXTINF:{},Artist – {}\n'.format(rng.randint(60, 600),
+                                                          title))
+                f.write('Group {}\\{}.mp3\n'.format(g + 1, title))
+            lines += 1 + 2 * entries
+    return lines
+
+def measure(func, repeat=3, setup=None):
+    """
+    Calls func repeat times, calling setup before each one, untimed.
+    Returns the timings and the result of the last call
+    """
+    timings = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+def summarize(timings, items):
+    best = min(timings)
+    return {'best': best,
+            'mean': sum(timings) / len(timings),
+            'items': items,
+            'items_per_second': items / best if best > 0 else None}
+
+def measure_startup(args, repeat=3):
+    """
+    Times running the interpreter with args, in a new process each time.
+    The playlist manipulator is run with -m, as a script it would be compiled
+    on every start
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=folder, check=True,
+                       stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def run_mode(**kwargs):
+    """ Runs execute_main in console mode with the given arguments, quietly"""
+    args = type('', (), kwargs)()
+    with redirect_stdout(io.StringIO()):
+        playlist_manipulator.execute_main(True, args)
+
+def run_benchmarks(workdir, depth=2, fanout=4, files=8, groups=100,
+                   entries=100, repeat=3, jobs=4):
+    """
+    Generates a library and a playlist in workdir and times each function
+    and mode on them
+
+    Returns
+    -------
+    results : dict
+        The summary of each benchmark, by name
+
+    """
+    library = os.path.join(workdir, 'library')
+    songcount = generate_library(library, depth, fanout, files)
+    merged = os.path.join(workdir, 'merged.m3u')
+    linecount = generate_playlist(merged, groups, entries)
+    output = os.path.join(workdir, 'output.m3u')
+    split_dir = os.path.join(workdir, 'split')
+    songs = [os.path.join(library, fn) for fn in
+             playlist_manipulator.get_all_files(library) if fn[0] != '?']
+    results = {}
+
+    for name, args in [('startup_bare', ['-c', 'pass']),
+                       ('startup_import', ['-c', 'import playlist_manipulator']),
+                       ('startup_mode2', ['-m', 'playlist_manipulator',
+                                          '-mode', '2', '-path', merged,
+                                          '-output_fn', output])]:
+        results[name] = summarize(measure_startup(args, repeat), 1)
+    
+    timings, _ = measure(lambda: sum(1 for _ in
+                         playlist_manipulator.iter_all_files(library)), repeat)
+    results['iter_all_files'] = summarize(timings, songcount)
+
+    timings, _ = measure(lambda: [playlist_manipulator.get_metadata(song)
+                                  for song in songs], repeat)
+    results['get_metadata'] = summarize(timings, songcount)
+
+    timings, _ = measure(lambda: list(playlist_manipulator.extract_metadata(
+                                      songs, jobs=jobs)), repeat)
+    results['extract_metadata_jobs'] = summarize(timings, songcount)
+
+    def read_groups():
+        with open(merged, 'r', encoding='utf-8') as f:
+            return sum(1 for _ in playlist_manipulator.iter_groups(f))
+    timings, _ = measure(read_groups, repeat)
+    results['iter_groups'] = summarize(timings, linecount)
+
+    playlist = playlist_manipulator.Playlist.read(merged)
+    group = playlist.groups[1]
+    to_insert = [('Song {}.mp3'.format(i),
+                  playlist_manipulator.Entry('New\\Song {}.mp3\n'.format(i),
+                                             '#EXTINF:0,Song {}\n'.format(i)))
+                 for i in range(entries)]
+    def insert():
+        target = playlist_manipulator.Group(group.name, list(group.entries))
+        target.insert(to_insert)
+    timings, _ = measure(insert, repeat)
+    results['group_insert'] = summarize(timings, entries)
+
+    def remove_output():
+        for fn in [output, playlist_manipulator.default_cache_fn(output)]:
+            if os.path.exists(fn):
+                os.remove(fn)
+    for name, options in [('mode1', {}), ('mode1_jobs', {'jobs': jobs}),
+                          ('mode1_async', {'jobs': jobs,
+                                           'asynchronous': True})]:
+        timings, _ = measure(lambda: run_mode(mode=1, path=[library],
+                                              prefix='', output_fn=output,
+                                              no_cache=True, **options),
+                             repeat, remove_output)
+        results[name] = summarize(timings, songcount)
+
+    remove_output()
+    run_mode(mode=1, path=[library], prefix='', output_fn=output)
+    timings, _ = measure(lambda: run_mode(mode=1, path=[library], prefix='',
+                                          output_fn=output), repeat)
+    results['mode1_cached'] = summarize(timings, songcount)
+
+    timings, _ = measure(lambda: run_mode(mode=2, path=[merged] * 4,
+                                          output_fn=output), repeat)
+    results['mode2'] = summarize(timings, 4 * linecount)
+
+    def clear_split():
+        shutil.rmtree(split_dir, ignore_errors=True)
+        os.makedirs(split_dir)
+    timings, _ = measure(lambda: run_mode(mode=3, path=[merged],
+                                          output_fn=split_dir, overwrite=True),
+                         repeat, clear_split)
+    results['mode3'] = summarize(timings, linecount)
+
+    def copy_merged():
+        shutil.copy(merged, output)
+    timings, _ = measure(lambda: run_mode(mode=4,
+                                          path=[os.path.join(library,
+                                                             'Album 1')],
+                                          prefix='', output_fn=output,
+                                          target_group=1, no_cache=True),
+                         repeat, copy_merged)
+    results['mode4'] = summarize(timings, files)
+
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the playlist "
+                    "manipulator on a generated library and playlist",
+                    formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-depth', type=int, default=2,
+                        help='Levels of subfolders in the library')
+    parser.add_argument('-fanout', type=int, default=4,
+                        help='Subfolders per folder')
+    parser.add_argument('-files', type=int, default=8,
+                        help='Songs per folder')
+    parser.add_argument('-groups', type=int, default=100,
+                        help='Groups in the generated playlist')
+    parser.add_argument('-entries', type=int, default=100,
+                        help='Songs per group in the generated playlist')
+    parser.add_argument('-repeat', type=int, default=3,
+                        help='Runs of each benchmark. The best is reported')
+    parser.add_argument('-jobs', type=int, default=4,
+                        help='Workers for the parallel benchmarks')
+    parser.add_argument('-workdir', type=str, default=None,
+                        help='Where the library is generated. A temporary '
+                        'folder is used and removed by default')
+    parser.add_argument('-output', type=str, default=None,
+                        help='JSON file to save the results to. They are '
+                        'printed by default')
+    args = parser.parse_args()
+
+    params = {key: val for key, val in vars(args).items()
+              if key not in ['workdir', 'output']}
+    if args.workdir is None:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run_benchmarks(workdir, **params)
+    else:
+        results = run_benchmarks(args.workdir, **params)
+
+    report = {'revision': git_revision(),
+              'python': sys.version,
+              'platform': platform.platform(),
+              'parameters': params,
+              'results': results}
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
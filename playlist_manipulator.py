@@ -8,16 +8,140 @@ Created on Sun May 10 11:44:44 2020
 import os
 import re
 from sys import argv
-import argparse
+from array import array
+from bisect import bisect_right
+from collections import deque
+from contextlib import ExitStack, contextmanager, nullcontext
+from functools import lru_cache, partial
+from itertools import chain, tee
+from operator import itemgetter
+import heapq
+import io
+import mmap
+import posixpath
+import struct
+import threading
+import time
+
+#mutagen, asyncio, sqlite3, argparse and the other modules only needed by
+#some of the modes are imported where they are used, so that merging and
+#splitting start quickly
 
-import mutagen
-    
 DEBUG = False
+#Read the tags of MP3, FLAC and M4A files directly, see read_header_metadata
+FAST_TAGS = True
 EXTENSIONS = ['mp3', 'flac', 'm4a', '.ogg']
+CACHE_EXTENSION = '.tagcache'
+MODE_TOOLTIP = "1. Create a playlist from a folder\n"\
+               "2. Merge several playlists\n"\
+               "3. Split a playlist, if it has components\n"\
+               "4. Insert songs from a folder into a playlist\n"\
+               "5. Index a library, or update its index\n"\
+               "6. Create a playlist from the index of a library\n"\
+               "7. Run the jobs of a job file\n"\
+               "8. Verify that the songs of a playlist exist\n"
+#The songs that timed out are read again with a deadline this many times
+#longer
+RETRY_TIMEOUT_FACTOR = 4
+#The number of bytes hashed at the beginning and at the end of a song to
+#recognize it after it was moved
+FINGERPRINT_WINDOW = 1 << 16
+#The number of songs passed to the writers of several playlists at once
+WRITE_BATCH_SIZE = 256
+#The number of files stat-ed by a single task when a playlist is verified
+VERIFY_BATCH_SIZE = 256
+#The number of file names whose natural_key is remembered
+NATURAL_KEY_CACHE_SIZE = 1 << 16
+NATURAL_SPLIT = re.compile('([0-9]+)')
+#The group headers of a playlist, with the line break ending them. Lines
+#are broken at \n, \r\n and \r, as in files opened in text mode
+GROUP_HEADER = re.compile(rb'(?:^|(?<=\r)(?!\n))#EXT(?:GRP:|M3U)'
+                          rb'[^\r\n]*(?:\r\n|\r|\n)?', re.M)
+NEWLINE = os.linesep.encode()
+#A line of a file, with any kind of line break
+LINE = re.compile(rb'[^\r\n]*(?:\r\n?|\n)|[^\r\n]+')
+#The largest part of a playlist that is rewritten in memory by mode 4.
+#Larger changes are written to a new file
+PATCH_LIMIT = 1 << 26
+#Seconds a tag cache or an index waits for another process writing to it,
+#before failing with "database is locked"
+DATABASE_TIMEOUT = 60
+#The number of songs stored in a tag cache between commits, so that an
+#interrupted run keeps most of what it read
+CACHE_COMMIT_INTERVAL = 1000
+
+def iter_all_files(path,prefix='',
+                   extensions = EXTENSIONS,
+                   group_title = '', memo = None):
+    """
+    Walks the folder and yields the songs and the group markers one by one,
+    in the same order as get_all_files, without holding the whole tree in
+    memory. The files of a folder come before its subfolders, both sorted
+    with natural_key, so the order does not depend on the file system.
+    
+    The type of the entries is taken from os.scandir, which in most cases
+    avoids a separate stat call per entry.
+
+    Parameters
+    ----------
+    path : str, path
+        The path to be parsed
+    prefix : str, path
+        a prefix that is attached to the beginning of the filenames. See
+        get_all_files
+    extensions : list of str, optional
+        The extensions of the files to keep, lowercase and without dot
+    group_title : str, optional
+        If not empty, '?#EXTGRP:' + group_title is yielded first
+    memo : BatchMemo, optional
+        The listings shared by the jobs of a batch. The default is None.
+
+    Yields
+    ------
+    str
+        '?#EXTGRP:' followed by a folder name, when a folder is entered, or
+        the filename of a song, with the prefix
+
+    """
+    #Folders that are still to be parsed. The next one is at the end
+    stack = [(path, prefix, group_title)]
+    while stack:
+        path, prefix, group_title = stack.pop()
+        if group_title != '':
+            yield '?#EXTGRP:' + group_title
+        
+        songs, folders = _list_folder(path, extensions, memo)
+        for name in songs:
+            yield os.path.join(prefix,name)
+        
+        #Reversed, so that the first folder is popped first
+        for folder in reversed(folders):
+            stack.append((os.path.join(path,folder),
+                          os.path.join(prefix,folder),
+                          folder))
 
-def get_all_files(path,prefix='',files = [],
-                  extensions = ['mp3', 'flac',
-                                'm4a', '.ogg'],
+def _list_folder(path, extensions, memo = None):
+    """ The songs and the subfolders of a folder, both in natural order"""
+    if memo is not None:
+        return memo.list_folder(path, extensions)
+    return _read_folder(path, extensions)
+
+def _read_folder(path, extensions):
+    songs = []
+    folders = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            #If name is a file, the extension is validated and kept
+            if entry.is_file():
+                if os.path.splitext(entry.name)[-1][1:].lower() in extensions:
+                    songs.append(entry.name)
+            else:
+                #If name is a folder, it is saved for later processing.
+                folders.append(entry.name)
+    return natural_sorted(songs), natural_sorted(folders)
+
+def get_all_files(path,prefix='',files = None,
+                  extensions = EXTENSIONS,
                   group_title = ''):
     """
     Parameters
@@ -33,7 +157,7 @@ def get_all_files(path,prefix='',files = [],
     files : list of str, optional
         The file list. Can be specified to
         include file names not in the folder. 
-        The default is [].
+        The default is None.
 
     Returns
     -------
@@ -41,36 +165,9 @@ def get_all_files(path,prefix='',files = [],
         the list of files in the directory
 
     """
-    
-    # All files and folders in path
-    ff = os.listdir(path)
-    
-    if files == []:
+    if files is None:
         files = []
-    
-    #Folders are gathered and are recursively added after files
-    folders = []
-    if group_title != '':
-        files.append('?#EXTGRP:' + group_title)
-    
-    for name in ff:
-        #If name is a file, the extension is validated and appened to the list
-        if os.path.isfile(os.path.join(path,name)):
-            if os.path.splitext(name)[-1][1:].lower() in extensions:
-                files.append(os.path.join(prefix,name))
-        else:
-            #If name is a folder, it is saved for later processing.
-            #Full path is added in the function call
-            folders.append(name)
-            
-    for folder in folders:
-        #The folder names will only have the name of the folder, without path,
-        #therfore that needs to be attached. The base remains unchanged
-        files = get_all_files(os.path.join(path,folder),
-                              os.path.join(prefix,folder),files,
-                              group_title=folder,
-                              extensions=extensions)
-        
+    files.extend(iter_all_files(path, prefix, extensions, group_title))
     return files
         
 
@@ -156,123 +253,2760 @@ def get_artist_title(meta, artist = '', title = ''):
     
     return artist, title
 
-def get_EXTINF(filename):
-    meta = mutagen.File(filename)
-    #If no meta can be retrieved 0 is used as placeholder for length
-    length = int(meta.info.length) if meta is not None else 0
+def _split_id3_text(data):
+    """
+    Decodes the data of an ID3v2 text frame into its list of values, as
+    mutagen does, or returns None if it is not well formed
+    """
+    if len(data) < 2:
+        return None
+    encoding = data[0]
+    if encoding in (0, 3):
+        codec, terminator = ('latin-1' if encoding == 0 else 'utf-8'), b'\x00'
+        parts = data[1:].split(terminator)
+    elif encoding in (1, 2):
+        codec, terminator = ('utf-16' if encoding == 1 else 'utf-16-be'), \
+                            b'\x00\x00'
+        #Only terminators on character boundaries count
+        parts = []
+        start = 1
+        for i in range(1, len(data) - 1, 2):
+            if data[i:i+2] == terminator:
+                parts.append(data[start:i])
+                start = i + 2
+        parts.append(data[start:])
+    else:
+        return None
+    #A terminator after the last value does not start a new one
+    if parts[-1] == b'':
+        parts.pop()
+    if not parts:
+        return None
+    try:
+        return [part.decode(codec) for part in parts]
+    except UnicodeDecodeError:
+        return None
+
+def _read_mp3_metadata(f, title):
+    """ The length, TPE1 and TIT2 of an MP3 file starting with an ID3v2 tag"""
+    header = f.read(10)
+    if len(header) < 10:
+        return None
+    version, flags, size = header[3], header[5], header[6:10]
+    #ID3v2.2, unsynchronisation and extended headers are left to mutagen
+    if version not in (3, 4) or flags & 0xC0 or any(b & 0x80 for b in size):
+        return None
+    end = 10 + _syncsafe(size)
+    
+    frames = {}
+    pos = 10
+    while pos + 10 <= end:
+        f.seek(pos)
+        frame_header = f.read(10)
+        if len(frame_header) < 10:
+            #Truncated file
+            return None
+        frame_id, frame_size = frame_header[:4], frame_header[4:8]
+        if frame_id == b'\x00\x00\x00\x00':
+            #Padding
+            break
+        if re.fullmatch(b'[A-Z0-9]{4}', frame_id) is None:
+            return None
+        if version == 4:
+            if any(b & 0x80 for b in frame_size):
+                return None
+            frame_size = _syncsafe(frame_size)
+        else:
+            frame_size = int.from_bytes(frame_size, 'big')
+        pos += 10 + frame_size
+        if pos > end:
+            return None
+        if frame_id in (b'TPE1', b'TIT2'):
+            #Compression, encryption, grouping or unsynchronisation
+            if frame_id in frames or \
+                    frame_header[9] & (0x4F if version == 4 else 0xE0):
+                return None
+            frames[frame_id] = _split_id3_text(f.read(frame_size))
+            if frames[frame_id] is None:
+                return None
+    
+    #Missing frames could be filled in from an ID3v1 tag by mutagen. It is
+    #looked for in the last 128 bytes, or before an APEv2 footer
+    if len(frames) < 2:
+        f.seek(0, 2)
+        f.seek(max(f.tell() - 133, 0))
+        if b'TAG' in f.read():
+            return None
+    #The footer flag of ID3v2.4
+    if version == 4 and flags & 0x10:
+        end += 10
+    import mutagen.mp3
+    info = mutagen.mp3.MPEGInfo(f, end)
+    return int(info.length), ', '.join(frames.get(b'TPE1', [])), \
+                ', '.join(frames[b'TIT2']) if b'TIT2' in frames else title
+
+def _syncsafe(data):
+    """ Integer stored in the lower 7 bits of each byte"""
+    value = 0
+    for b in data:
+        value = (value << 7) | b
+    return value
+
+def _read_flac_metadata(f, title):
+    """ The length, ARTIST (or ALBUMARTIST) and TITLE of a FLAC file"""
+    if f.read(4) != b'fLaC':
+        return None
+    length = None
+    comments = None
+    last = False
+    while not last:
+        header = f.read(4)
+        if len(header) < 4:
+            return None
+        last = header[0] & 0x80
+        block_type = header[0] & 0x7F
+        size = int.from_bytes(header[1:], 'big')
+        if length is None and block_type != 0:
+            return None
+        if block_type == 0:
+            data = f.read(size)
+            if length is not None or len(data) < 18:
+                return None
+            sample_rate = int.from_bytes(data[10:13], 'big') >> 4
+            total_samples = int.from_bytes(data[13:18], 'big') & 0xFFFFFFFFF
+            if sample_rate == 0:
+                return None
+            length = int(total_samples / float(sample_rate))
+        elif block_type == 4:
+            if comments is not None:
+                return None
+            comments = _parse_vorbis_comments(f.read(size))
+            if comments is None:
+                return None
+        elif block_type == 6:
+            #The size of pictures is checked, as mutagen does not trust it
+            start = f.tell()
+            picture = f.read(8)
+            mime_length = int.from_bytes(picture[4:8], 'big')
+            f.seek(mime_length, 1)
+            description_length = int.from_bytes(f.read(4), 'big')
+            f.seek(description_length + 16, 1)
+            data_length = int.from_bytes(f.read(4), 'big')
+            if f.tell() - start + data_length != size:
+                return None
+            f.seek(start + size)
+        else:
+            f.seek(size, 1)
+    if length is None:
+        return None
+    
+    if comments is None:
+        return length, '', title
+    artist = comments.get('artist', comments.get('albumartist'))
+    return length, ', '.join(artist) if artist is not None else '', \
+                ', '.join(comments['title']) if 'title' in comments else title
+
+def _parse_vorbis_comments(data):
+    """
+    The values of each key of a Vorbis comment block, with lowercase keys,
+    or None if it is not well formed
+    """
+    comments = {}
+    try:
+        vendor_length = int.from_bytes(data[:4], 'little')
+        pos = 4 + vendor_length
+        count = int.from_bytes(data[pos:pos+4], 'little')
+        pos += 4
+        for _ in range(count):
+            length = int.from_bytes(data[pos:pos+4], 'little')
+            pos += 4
+            comment = data[pos:pos+length]
+            if len(comment) != length:
+                return None
+            pos += length
+            key, value = comment.decode('utf-8').split('=', 1)
+            if not key or any(not 0x20 <= ord(c) <= 0x7D for c in key):
+                return None
+            comments.setdefault(key.lower(), []).append(value)
+    except (UnicodeDecodeError, ValueError):
+        return None
+    #mutagen parses the block itself, so its size must be exact
+    if pos != len(data) or len(data) < 8:
+        return None
+    return comments
+
+def _read_atoms(f, start, end):
+    """ Yields the type, start of data and end of the MP4 atoms in a range"""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        size, name = struct.unpack('>I4s', header)
+        data = pos + 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            data += 8
+        elif size == 0:
+            size = end - pos
+        if size < data - pos or pos + size > end:
+            raise ValueError('Invalid atom')
+        yield name, data, pos + size
+        pos += size
+
+def _find_atom(f, start, end, name):
+    for atom, data, atom_end in _read_atoms(f, start, end):
+        if atom == name:
+            return data, atom_end
+    return None
+
+def _read_mp4_metadata(f, title):
+    """ The length, ©ART and ©nam of an MP4 file"""
+    try:
+        f.seek(0, 2)
+        moov = _find_atom(f, 0, f.tell(), b'moov')
+        if moov is None:
+            return None
+        
+        #The length of the first audio track
+        length = None
+        for name, data, end in _read_atoms(f, *moov):
+            if name != b'trak':
+                continue
+            mdia = _find_atom(f, data, end, b'mdia')
+            hdlr = mdia and _find_atom(f, *mdia, b'hdlr')
+            if hdlr is None:
+                return None
+            f.seek(hdlr[0] + 8)
+            if f.read(4) != b'soun':
+                continue
+            mdhd = _find_atom(f, *mdia, b'mdhd')
+            if mdhd is None:
+                return None
+            f.seek(mdhd[0])
+            version = f.read(1)[0]
+            if version == 0:
+                f.seek(mdhd[0] + 12)
+                unit, duration = struct.unpack('>2I', f.read(8))
+            elif version == 1:
+                f.seek(mdhd[0] + 20)
+                unit, duration = struct.unpack('>IQ', f.read(12))
+            else:
+                return None
+            length = int(float(duration) / unit)
+            break
+        if length is None:
+            return None
+        
+        ilst = None
+        udta = _find_atom(f, *moov, b'udta')
+        meta = udta and _find_atom(f, *udta, b'meta')
+        if meta is not None:
+            #meta has a version and flags before its children
+            ilst = _find_atom(f, meta[0] + 4, meta[1], b'ilst')
+        if ilst is None:
+            return length, '', title
+        
+        values = {}
+        for name, data, end in _read_atoms(f, *ilst):
+            if name not in (b'\xa9ART', b'\xa9nam'):
+                continue
+            if name in values:
+                return None
+            values[name] = []
+            for child, child_data, child_end in _read_atoms(f, data, end):
+                f.seek(child_data)
+                flags = int.from_bytes(f.read(4)[1:], 'big')
+                if child != b'data' or flags not in (0, 1):
+                    return None
+                f.seek(child_data + 8)
+                values[name].append(
+                    f.read(child_end - child_data - 8).decode('utf-8'))
+    except (ValueError, TypeError, IndexError, struct.error,
+            UnicodeDecodeError):
+        return None
+    
+    artist = values.get(b'\xa9ART')
+    return length, ', '.join(artist) if artist is not None else '', \
+                ', '.join(values[b'\xa9nam']) if b'\xa9nam' in values \
+                else title
+
+def read_header_metadata(filename):
+    """
+    Reads the length, artist and title of MP3 (with ID3v2.3/2.4 tags), FLAC
+    and M4A files directly, with the same results as get_metadata, but
+    without parsing the rest of the tags, such as cover art, which are
+    skipped over. Only the headers, the needed tags and, for MP3, the start
+    of the audio are read.
+
+    Parameters
+    ----------
+    filename : str, path
+        The song to read
+
+    Returns
+    -------
+    (length, artist, title) : tuple
+        Or None if the file is in another format, or has anything unusual
+        that is left to mutagen
+
+    """
+    import mutagen
+    extension = os.path.splitext(filename)[-1].lower()
+    title = os.path.splitext(os.path.basename(filename))[0]
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(10)
+            f.seek(0)
+            if extension == '.mp3' and header[:3] == b'ID3':
+                return _read_mp3_metadata(f, title)
+            if extension == '.flac' and header[:4] == b'fLaC':
+                return _read_flac_metadata(f, title)
+            if extension == '.m4a' and header[4:8] == b'ftyp':
+                return _read_mp4_metadata(f, title)
+    except (OSError, mutagen.MutagenError, IndexError, struct.error):
+        #Damaged files are left to mutagen as well
+        pass
+    return None
+
+def get_metadata(filename):
+    """
+    Reads the information needed for the #EXTINF line of a song
+
+    Parameters
+    ----------
+    filename : str, path
+        The song to read
+
+    Returns
+    -------
+    length : int
+        Length in seconds, 0 if it cannot be retrieved
+    artist : str
+        Empty if it cannot be retrieved
+    title : str
+        The file name without extension if it cannot be retrieved
+
+    """
+    if FAST_TAGS and not DEBUG:
+        meta = read_header_metadata(filename)
+        if meta is not None:
+            return meta
+    
+    import mutagen
+    meta = mutagen.File(filename)
+    #If no meta can be retrieved 0 is used as placeholder for length
+    length = int(meta.info.length) if meta is not None else 0
+    
+    #if the file name cannot be retrieved, the file name is 
+    #used instead (default value of title)
+    artist, title = get_artist_title(meta,
+            title = os.path.splitext(
+                        os.path.basename(filename))[0])
+    return length, artist, title
+
+def format_EXTINF(length, artist, title):
+    #The EXTINF field only has 2 fields, {} - {} is only a 
+    #convention. If the artist cannot be retrieved, it is skipped
+    if len(artist)>0:
+        return '#EXTINF:{},{} – {}\n'.format(
+                                            length,
+                                            artist,
+                                            title)
+    else:
+        return '#EXTINF:{},{}\n'.format(
+                                        length,
+                                        title)
+
+def get_EXTINF(filename):
+    return format_EXTINF(*get_metadata(filename))
+
+def file_signature(filename):
+    """ Size, modification time and inode. Changes when the file is edited"""
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+def file_fingerprint(filename, size, window = FINGERPRINT_WINDOW):
+    """
+    A hash of the first and last window bytes of a file of the given size.
+    Together with the size, it stays the same when the file is moved or
+    renamed, but changes when its tags are edited
+    """
+    import hashlib
+    with open(filename, 'rb') as f:
+        digest = hashlib.blake2b(f.read(window), digest_size=16)
+        if size > window:
+            f.seek(max(window, size - window))
+            digest.update(f.read(window))
+    return digest.digest()
+
+def default_cache_fn(playlist_fn):
+    """ The tag cache belonging to a playlist is stored next to it"""
+    return os.path.splitext(playlist_fn)[0] + CACHE_EXTENSION
+
+class RunStats:
+    """
+    Collects the timings and counters of a run, for --stats and -stats_fn.
+    Functions take stats=None by default, in which case nothing is measured.
+    
+    Phase times are exclusive: the time spent in a phase started within
+    another phase is only counted for the inner one.
+    """
+    
+    def __init__(self, slowest=10):
+        """
+        Parameters
+        ----------
+        slowest : int, optional
+            The number of slowest songs to keep. The default is 10.
+
+        """
+        self.phases = {}
+        self.counters = {}
+        self.slowest_count = slowest
+        self._slowest = []
+        self._stack = []
+        self._lock = threading.Lock()
+    
+    def count(self, name, value = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def _start(self):
+        self._stack.append([time.perf_counter(), 0])
+    
+    def _stop(self, name):
+        start, inner = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self.phases[name] = self.phases.get(name, 0) + elapsed - inner
+        if self._stack:
+            self._stack[-1][1] += elapsed
+    
+    @contextmanager
+    def phase(self, name):
+        """ Adds the time spent in the with block to the phase"""
+        self._start()
+        try:
+            yield
+        finally:
+            self._stop(name)
+    
+    def timed(self, name, iterable):
+        """ Yields from iterable, adding the time spent in it to the phase"""
+        iterator = iter(iterable)
+        while True:
+            self._start()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._stop(name)
+            yield item
+    
+    def record_file(self, filename, seconds):
+        """ Records the time it took to read the metadata of a song"""
+        with self._lock:
+            self.counters['songs_read'] = self.counters.get('songs_read', 0) + 1
+            self.phases['song_reads_cumulative'] = \
+                        self.phases.get('song_reads_cumulative', 0) + seconds
+            item = (seconds, filename)
+            if len(self._slowest) < self.slowest_count:
+                heapq.heappush(self._slowest, item)
+            elif item > self._slowest[0]:
+                heapq.heapreplace(self._slowest, item)
+    
+    def count_cache(self, cache):
+        """
+        Adds the hits and misses of a MetadataCache. Misses passed on to an
+        inner cache only count if they miss there too
+        """
+        while cache is not None:
+            if isinstance(cache, DeadlineCache):
+                self.count('timeouts', len(cache.timed_out) + cache.recovered)
+                self.count('timeouts_recovered', cache.recovered)
+                cache = cache.inner
+                continue
+            self.count('cache_hits', cache.hits)
+            if getattr(cache, 'moved', 0):
+                self.count('cache_moved', cache.moved)
+            inner = getattr(cache, 'inner', None)
+            if inner is None:
+                self.count('cache_misses', cache.misses)
+            cache = inner
+    
+    def as_dict(self):
+        result = {'phases': dict(self.phases),
+                  'counters': dict(self.counters),
+                  'slowest': [{'file': fn, 'seconds': seconds} for seconds, fn
+                              in sorted(self._slowest, reverse=True)]}
+        total = self.phases.get('total', 0)
+        if total > 0:
+            result['songs_per_second'] = self.counters.get('songs', 0) / total
+        lookups = self.counters.get('cache_hits', 0) \
+                    + self.counters.get('cache_misses', 0)
+        if lookups > 0:
+            result['cache_hit_rate'] = self.counters['cache_hits'] / lookups
+        return result
+    
+    def summary(self):
+        """ The statistics as printable text"""
+        stats = self.as_dict()
+        lines = ['Timings (s):']
+        for name, seconds in stats['phases'].items():
+            lines.append('  {:<22}{:10.3f}'.format(name, seconds))
+        lines.append('Counters:')
+        for name, value in stats['counters'].items():
+            lines.append('  {:<22}{:>10}'.format(name, value))
+        for name in ['songs_per_second', 'cache_hit_rate']:
+            if name in stats:
+                lines.append('{:<24}{:10.2f}'.format(name, stats[name]))
+        if stats['slowest']:
+            lines.append('Slowest songs (s):')
+            for item in stats['slowest']:
+                lines.append('  {:8.3f} {}'.format(item['seconds'],
+                                                   item['file']))
+        return '\n'.join(lines)
+
+class MetadataCache:
+    """
+    Base class of the caches used by extract_metadata. Subclasses implement
+    lookup and store, keyed by the filename and its file_signature
+    """
+    hits = 0
+    misses = 0
+    
+    def lookup(self, filename, signature):
+        """
+        Returns the stored (length, artist, title) of the file or None, if
+        the file is not in the cache or it has changed since
+        """
+        return None
+    
+    def store(self, filename, signature, meta):
+        """ Saves the (length, artist, title) of the file"""
+        pass
+    
+    def get_metadata(self, filename, read = get_metadata):
+        """
+        Same as get_metadata, but only reads the file if it is not cached.
+        read is the function used for reading it
+        """
+        signature = file_signature(filename)
+        meta = self.lookup(filename, signature)
+        if meta is None:
+            meta = read(filename)
+            self.store(filename, signature, meta)
+        return meta
+    
+    def commit(self):
+        """
+        Saves the stored entries, so that they are kept if the run is
+        interrupted. Caches wrapping an inner one commit that one
+        """
+        inner = getattr(self, 'inner', None)
+        if inner is not None:
+            inner.commit()
+    
+    def needs_fingerprints(self):
+        """
+        Whether store uses the file_fingerprint of the songs, which can then
+        be computed where the song is read and given with set_fingerprint
+        """
+        inner = getattr(self, 'inner', None)
+        return inner is not None and inner.needs_fingerprints()
+    
+    def set_fingerprint(self, filename, fingerprint):
+        """ The file_fingerprint of a song that is about to be stored"""
+        inner = getattr(self, 'inner', None)
+        if inner is not None:
+            inner.set_fingerprint(filename, fingerprint)
+    
+    def close(self):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+class TagCache(MetadataCache):
+    """
+    Stores the results of get_metadata in an SQLite database, so that
+    unchanged songs do not have to be opened again on the next run. An entry
+    is only used if the size, modification time and inode of the file are the
+    same as when it was read. If there are more than max_entries entries,
+    the ones that were not used for the longest time are removed on close.
+    The entries are also committed every CACHE_COMMIT_INTERVAL stores.
+    
+    Songs that are not found by their path are looked up by their size and
+    file_fingerprint, so that moved and renamed songs are not read again.
+    These are counted in moved. Songs whose title is their old filename are
+    always read again, as it may not come from a tag. The fingerprint is
+    only computed by lookup if a song of the same size is stored, otherwise
+    it is computed when the song is stored, i.e. where it is read.
+    
+    The cache can be shared between threads.
+    """
+    
+    def __init__(self, filename, max_entries=1000000, rebuild=False):
+        """
+        Parameters
+        ----------
+        filename : str, path
+            The database file. Created if it does not exist
+        max_entries : int, optional
+            The number of songs to keep. The default is 1000000.
+        rebuild : bool, optional
+            Discard all the stored entries. The default is False.
+
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.moved = 0
+        self._lock = threading.Lock()
+        #Entries used in this run are marked with the start time of the run
+        self._now = int(time.time())
+        self._used = []
+        #The songs stored since the last commit
+        self._pending = 0
+        #The fingerprints of the songs that missed, until they are stored
+        self._fingerprints = {}
+        import sqlite3
+        self._db = sqlite3.connect(filename, timeout=DATABASE_TIMEOUT,
+                                   check_same_thread=False)
+        if rebuild:
+            self._db.execute('DROP TABLE IF EXISTS tags')
+        self._db.execute('CREATE TABLE IF NOT EXISTS tags ('
+                         'path TEXT PRIMARY KEY, size INTEGER, '
+                         'mtime INTEGER, inode INTEGER, length INTEGER, '
+                         'artist TEXT, title TEXT, used INTEGER, '
+                         'fingerprint BLOB)')
+        #Caches written before the fingerprints were added are kept, their
+        #songs just cannot be found when moved
+        columns = [row[1] for row in
+                   self._db.execute('PRAGMA table_info(tags)')]
+        if 'fingerprint' not in columns:
+            self._db.execute('ALTER TABLE tags ADD COLUMN fingerprint BLOB')
+        self._db.execute('CREATE INDEX IF NOT EXISTS tags_used ON tags(used)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS tags_fingerprint '
+                         'ON tags(fingerprint)')
+        self._db.commit()
+    
+    def lookup(self, filename, signature):
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime, inode, length, '
+                                   'artist, title FROM tags WHERE path=?',
+                                   (filename,)).fetchone()
+            if row is not None and tuple(row[:3]) == tuple(signature):
+                self.hits += 1
+                self._used.append((self._now, filename))
+                return row[3:]
+        
+        with self._lock:
+            moved = self._db.execute('SELECT 1 FROM tags WHERE size=? AND '
+                                     'fingerprint IS NOT NULL LIMIT 1',
+                                     (signature[0],)).fetchone()
+            if moved is None:
+                self.misses += 1
+                return None
+        
+        fingerprint = file_fingerprint(filename, signature[0])
+        with self._lock:
+            for path, *meta in self._db.execute('SELECT path, length, '
+                                    'artist, title FROM tags '
+                                    'WHERE fingerprint=? AND size=?',
+                                    (fingerprint, signature[0])):
+                #The title may have been taken from the old filename
+                if meta[2] == os.path.splitext(os.path.basename(path))[0]:
+                    continue
+                self.hits += 1
+                self.moved += 1
+                self._insert(filename, signature, meta, fingerprint)
+                return tuple(meta)
+            self.misses += 1
+            self._fingerprints[filename] = fingerprint
+        return None
+    
+    def _insert(self, filename, signature, meta, fingerprint):
+        self._db.execute('INSERT OR REPLACE INTO tags (path, size, mtime, '
+                         'inode, length, artist, title, used, fingerprint) '
+                         'VALUES (?,?,?,?,?,?,?,?,?)',
+                         (filename, *signature, *meta, self._now,
+                          fingerprint))
+        self._pending += 1
+        if self._pending >= CACHE_COMMIT_INTERVAL:
+            self._commit()
+    
+    def needs_fingerprints(self):
+        return True
+    
+    def set_fingerprint(self, filename, fingerprint):
+        with self._lock:
+            self._fingerprints[filename] = fingerprint
+    
+    def store(self, filename, signature, meta):
+        with self._lock:
+            fingerprint = self._fingerprints.pop(filename, None)
+        if fingerprint is None:
+            fingerprint = file_fingerprint(filename, signature[0])
+        with self._lock:
+            self._insert(filename, signature, meta, fingerprint)
+    
+    def _commit(self):
+        self._db.executemany('UPDATE tags SET used=? WHERE path=?',
+                             self._used)
+        self._used = []
+        self._pending = 0
+        self._db.commit()
+    
+    def commit(self):
+        with self._lock:
+            self._commit()
+    
+    def close(self):
+        """ Saves the changes and evicts the least recently used entries"""
+        with self._lock:
+            self._commit()
+            count = self._db.execute('SELECT COUNT(*) FROM tags').fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute('DELETE FROM tags WHERE path IN (SELECT path '
+                                 'FROM tags ORDER BY used LIMIT ?)',
+                                 (count - self.max_entries,))
+            self._db.commit()
+            self._db.close()
+
+class PlaylistCache(MetadataCache):
+    """
+    Uses the #EXTINF lines of a previously created playlist as a cache, for
+    regenerating it incrementally. A song is only read again if it was
+    modified after the playlist was written. The number of songs added,
+    removed and updated since the previous version are counted.
+    """
+    
+    def __init__(self, playlist_fn, input_folder, prefix, inner=None):
+        """
+        Parameters
+        ----------
+        playlist_fn : str, path
+            The previous version of the playlist. If it does not exist,
+            every song counts as added
+        input_folder : str, path
+            The folder the playlist was created from
+        prefix : str
+            The prefix the playlist was created with
+        inner : MetadataCache, optional
+            Consulted for the songs that are not in the playlist or have
+            changed. The default is None.
+
+        """
+        self.inner = inner
+        self.added = 0
+        self.updated = 0
+        self._lock = threading.Lock()
+        self._seen = 0
+        self._entries = {}
+        self._since = 0
+        if not os.path.exists(playlist_fn):
+            return
+        
+        self._since = os.stat(playlist_fn).st_mtime_ns
+        extinf = None
+        with open(playlist_fn, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line[:8] == '#EXTINF:':
+                    extinf = line
+                elif line[:1] != '#' and line.strip() != '' \
+                        and extinf is not None:
+                    #'#EXTINF:length,text' is formatted back unchanged from
+                    #an empty artist and the whole text as title
+                    length, _, text = extinf[8:].rstrip('\n').partition(',')
+                    true_path = get_true_path(line.rstrip('\n'),
+                                              input_folder, prefix)
+                    self._entries[true_path] = (length, '', text)
+                    extinf = None
+    
+    @property
+    def removed(self):
+        """ Songs of the previous playlist that have not been looked up"""
+        return len(self._entries) - self._seen
+    
+    def lookup(self, filename, signature):
+        meta = self._entries.get(filename)
+        with self._lock:
+            if meta is None:
+                self.added += 1
+            else:
+                self._seen += 1
+                if signature[1] <= self._since:
+                    self.hits += 1
+                    return meta
+                self.updated += 1
+            self.misses += 1
+        if self.inner is not None:
+            return self.inner.lookup(filename, signature)
+        return None
+    
+    def store(self, filename, signature, meta):
+        if self.inner is not None:
+            self.inner.store(filename, signature, meta)
+
+class LibraryIndex(MetadataCache):
+    """
+    Stores the path, folder, length, artist and title of every song of a
+    library in an SQLite database, so that playlists can be generated from
+    queries without walking the folders or opening the songs. Scanning the
+    library again only reads the songs that changed, as with TagCache.
+    
+    The paths are stored relative to the scanned folder, in the order of
+    iter_all_files.
+    """
+    
+    def __init__(self, filename):
+        """
+        Parameters
+        ----------
+        filename : str, path
+            The database file. Created if it does not exist
+
+        """
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._root = ''
+        #The signatures of the songs being scanned, saved with their row
+        self._signatures = {}
+        import sqlite3
+        self._db = sqlite3.connect(filename, timeout=DATABASE_TIMEOUT,
+                                   check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS songs ('
+                         'path TEXT PRIMARY KEY, folder TEXT, '
+                         'position INTEGER, size INTEGER, mtime INTEGER, '
+                         'inode INTEGER, length INTEGER, artist TEXT, '
+                         'title TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS songs_position '
+                         'ON songs(position)')
+        self._db.commit()
+    
+    def lookup(self, filename, signature):
+        path = os.path.relpath(filename, self._root)
+        with self._lock:
+            self._signatures[filename] = signature
+            row = self._db.execute('SELECT size, mtime, inode, length, '
+                                   'artist, title FROM songs WHERE path=?',
+                                   (path,)).fetchone()
+            if row is None or tuple(row[:3]) != tuple(signature):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[3:]
+    
+    def scan(self, root, jobs=1, processes=False, stats=None, memo=None):
+        """
+        Indexes the songs in root and its subfolders. Songs that are no
+        longer there are removed from the index
+
+        Parameters
+        ----------
+        root : str, path
+            The folder of the library
+        jobs, processes, stats :
+            See extract_metadata
+        memo : BatchMemo, optional
+            See iter_all_files
+
+        Returns
+        -------
+        songcount : int
+            The number of songs in the index
+        removed : int
+            The number of songs removed from the index
+
+        """
+        self._root = root
+        tracks, ahead = tee(fn for fn in iter_all_files(root, memo=memo)
+                            if fn[0]!='?')
+        metas = extract_metadata((os.path.join(root, fn) for fn in ahead),
+                                 jobs, processes, self, stats)
+        songcount = 0
+        with self._lock:
+            #Songs that are not found again keep the NULL position
+            self._db.execute('UPDATE songs SET position=NULL')
+        for fn, meta in zip(tracks, metas):
+            with self._lock:
+                signature = self._signatures.pop(os.path.join(root, fn))
+                self._db.execute('INSERT OR REPLACE INTO songs VALUES '
+                                 '(?,?,?,?,?,?,?,?,?)',
+                                 (fn, os.path.dirname(fn), songcount,
+                                  *signature, *meta))
+            songcount += 1
+        with self._lock:
+            removed = self._db.execute('DELETE FROM songs '
+                                       'WHERE position IS NULL').rowcount
+            self._db.commit()
+        return songcount, removed
+    
+    def query(self, folder=None, artist=None, min_length=None,
+              max_length=None, modified_since=None):
+        """
+        Yields the songs matching every specified condition, in the order
+        of the library
+
+        Parameters
+        ----------
+        folder : str, path, optional
+            Only songs in this folder, relative to the library, or its
+            subfolders
+        artist : str, optional
+            Only songs whose artist contains this, ignoring case
+        min_length : int, optional
+            Only songs at least this many seconds long
+        max_length : int, optional
+            Only songs at most this many seconds long
+        modified_since : float, optional
+            Only songs modified after this timestamp
+
+        Yields
+        ------
+        (path, folder, length, artist, title) : tuple
+
+        """
+        conditions = []
+        params = []
+        if folder is not None and os.path.normpath(folder) != '.':
+            folder = os.path.normpath(folder)
+            conditions.append('(folder=? OR substr(folder,1,?)=?)')
+            params += [folder, len(folder) + 1, folder + os.sep]
+        if artist:
+            conditions.append("artist LIKE ? ESCAPE '\\'")
+            params.append('%' + re.sub(r'([\\%_])', r'\\\1', artist) + '%')
+        if min_length is not None:
+            conditions.append('length>=?')
+            params.append(min_length)
+        if max_length is not None:
+            conditions.append('length<=?')
+            params.append(max_length)
+        if modified_since is not None:
+            conditions.append('mtime>=?')
+            params.append(int(modified_since * 10**9))
+        sql = 'SELECT path, folder, length, artist, title FROM songs'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        yield from self._db.execute(sql + ' ORDER BY position', params)
+    
+    def write_playlist(self, output_fn, prefix='', group_title='', **query):
+        """
+        Writes the songs matching the query to a playlist, in the format of
+        save_tracklist_to_file. A group is started for every folder that
+        has matching songs. See query for the conditions
+
+        Returns
+        -------
+        songcount : int
+            The number of songs written
+        groupcount : int
+            The number of groups written
+
+        """
+        rows, ahead = tee(self.query(**query))
+        
+        def tracks():
+            if group_title != '':
+                yield '?#EXTGRP:' + group_title
+            current = ''
+            for path, folder, *_ in rows:
+                if folder != current:
+                    yield '?#EXTGRP:' + os.path.basename(folder)
+                    current = folder
+                yield os.path.join(prefix, path)
+        
+        return write_tracklist(tracks(), (row[2:] for row in ahead),
+                               output_fn)
+    
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class MemoCache(MetadataCache):
+    """
+    Keeps the metadata read by the jobs of a batch in memory, in front of
+    the cache of each job, so a song shared by several playlists is only
+    read once, even if the jobs reach it at the same time. See BatchMemo
+    """
+    
+    def __init__(self, memo, inner=None):
+        self.memo = memo
+        self.inner = inner
+    
+    def _done(self, filename, signature, meta):
+        from concurrent.futures import Future
+        future = Future()
+        future.set_result(meta)
+        with self.memo.lock:
+            self.memo.tags[filename] = (signature, future)
+    
+    def lookup(self, filename, signature):
+        #Songs being read by another job are not waited for here
+        with self.memo.lock:
+            entry = self.memo.tags.get(filename)
+            if entry is not None and entry[0] == signature \
+                    and entry[1].done() and entry[1].result() is not None:
+                self.hits += 1
+                return entry[1].result()
+            self.misses += 1
+        if self.inner is None:
+            return None
+        meta = self.inner.lookup(filename, signature)
+        if meta is not None:
+            self._done(filename, signature, meta)
+        return meta
+    
+    def store(self, filename, signature, meta):
+        self._done(filename, signature, meta)
+        if self.inner is not None:
+            self.inner.store(filename, signature, meta)
+    
+    def get_metadata(self, filename, read = get_metadata):
+        from concurrent.futures import Future
+        signature = file_signature(filename)
+        with self.memo.lock:
+            entry = self.memo.tags.get(filename)
+            owner = entry is None or entry[0] != signature
+            if owner:
+                self.misses += 1
+                future = Future()
+                self.memo.tags[filename] = (signature, future)
+            else:
+                self.hits += 1
+                future = entry[1]
+        if not owner:
+            #Waits if another job is reading it. None if that failed
+            meta = future.result()
+            return read(filename) if meta is None else meta
+        
+        try:
+            meta = None
+            if self.inner is not None:
+                meta = self.inner.lookup(filename, signature)
+            if meta is None:
+                meta = read(filename)
+                if self.inner is not None:
+                    self.inner.store(filename, signature, meta)
+        except BaseException:
+            with self.memo.lock:
+                if self.memo.tags.get(filename, (None, None))[1] is future:
+                    del self.memo.tags[filename]
+            future.set_result(None)
+            raise
+        future.set_result(meta)
+        return meta
+
+class BatchMemo:
+    """
+    The folder listings and the metadata of the songs, shared by the jobs
+    of a batch. The folders are assumed not to change during the batch
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listings = {}
+        self.tags = {}
+    
+    def list_folder(self, path, extensions):
+        key = (os.path.abspath(path), tuple(extensions))
+        with self.lock:
+            listing = self.listings.get(key)
+        if listing is None:
+            listing = _read_folder(path, extensions)
+            with self.lock:
+                self.listings[key] = listing
+        return listing
+    
+    @contextmanager
+    def cache(self, inner):
+        """ Wraps the cache given by the inner context manager"""
+        with inner as cache:
+            yield MemoCache(self, cache)
+
+class _ReadTimeout(Exception):
+    pass
+
+class _DaemonExecutor:
+    """
+    A pool of at most max_workers daemon threads. Unlike the threads of
+    ThreadPoolExecutor, these are not waited for when the program exits, so
+    a read that never returns does not keep it from exiting.
+    
+    A thread whose task was given up with abandon no longer counts as a
+    worker, so a new one can start in its place. It exits once its task is
+    done
+    """
+    
+    def __init__(self, max_workers):
+        import queue
+        self.max_workers = max_workers
+        self._tasks = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._idle = 0
+        #The futures of the tasks running in counted workers
+        self._running = set()
+    
+    def _work(self):
+        while True:
+            future, func, args = self._tasks.get()
+            with self._lock:
+                #Tasks whose caller stopped waiting are skipped
+                if not future.set_running_or_notify_cancel():
+                    self._idle += 1
+                    continue
+                self._running.add(future)
+            result = error = None
+            try:
+                result = func(*args)
+            except BaseException as e:
+                error = e
+            #The worker is free before the caller sees the result, so the
+            #next task of the caller goes to it
+            with self._lock:
+                abandoned = future not in self._running
+                self._running.discard(future)
+                if not abandoned:
+                    self._idle += 1
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+            if abandoned:
+                return
+    
+    def abandon(self, future):
+        """ Stops counting the worker running the task of future"""
+        with self._lock:
+            if future in self._running:
+                self._running.discard(future)
+                self._workers -= 1
+    
+    def submit(self, func, *args):
+        from concurrent.futures import Future
+        future = Future()
+        #A free worker is reserved for the task, or a new one is started.
+        #Once all of them are busy, the tasks wait for the first free one
+        with self._lock:
+            if self._idle > 0:
+                self._idle -= 1
+            elif self._workers < self.max_workers:
+                self._workers += 1
+                threading.Thread(target=self._work, daemon=True).start()
+        self._tasks.put((future, func, args))
+        return future
+
+class DeadlineCache(MetadataCache):
+    """
+    Looks up and reads every song under a deadline, through the inner
+    cache, so that a song on a stalled network drive does not stall the
+    whole run. Songs that are not done in timeout seconds get the metadata
+    of a song without tags, which is not stored in the cache, and are kept
+    in timed_out, to be read again with retry.
+    
+    The songs are read by a pool of daemon threads, twice as many as jobs,
+    so that a few stalled reads leave the others running. A read that timed
+    out cannot be stopped, it is left to finish in its thread, and a new
+    thread takes its place in the pool.
+    
+    The deadline is not applied to songs read in other processes.
+    """
+    
+    def __init__(self, timeout, inner=None, jobs=1):
+        self.timeout = timeout
+        self.inner = inner
+        self.timed_out = []
+        self.recovered = 0
+        self._lock = threading.Lock()
+        self._executor = _DaemonExecutor(2 * max(jobs or 1, 1))
+    
+    def lookup(self, filename, signature):
+        if self.inner is None:
+            return None
+        return self.inner.lookup(filename, signature)
+    
+    def store(self, filename, signature, meta):
+        if self.inner is not None:
+            self.inner.store(filename, signature, meta)
+    
+    def _read(self, filename, read):
+        if self.inner is None:
+            return read(filename)
+        return self.inner.get_metadata(filename, read)
+    
+    def _bounded(self, filename, read, timeout = None):
+        """
+        Looks up or reads the song in a thread of the pool, raising
+        _ReadTimeout if it takes too long
+        """
+        from concurrent.futures import wait
+        future = self._executor.submit(self._read, filename, read)
+        if not wait([future], self.timeout if timeout is None
+                    else timeout).done:
+            if not future.cancel():
+                self._executor.abandon(future)
+            raise _ReadTimeout(filename)
+        return future.result()
+    
+    def get_metadata(self, filename, read = get_metadata):
+        try:
+            return self._bounded(filename, read)
+        except _ReadTimeout:
+            with self._lock:
+                self.timed_out.append(filename)
+            return 0, '', os.path.splitext(os.path.basename(filename))[0]
+    
+    def _retry(self, read, timeout, filename):
+        try:
+            return self._bounded(filename, read, timeout)
+        except _ReadTimeout:
+            return None
+    
+    def retry(self, jobs=1, read=None, factor=RETRY_TIMEOUT_FACTOR):
+        """
+        Reads the songs that timed out again, jobs at a time, each with a
+        deadline factor times longer. The songs read are stored in the
+        inner cache and removed from timed_out. They are read with
+        get_metadata, unless read is specified
+
+        Returns
+        -------
+        dict
+            The (length, artist, title) of the songs read, by filename
+
+        """
+        with self._lock:
+            filenames = list(dict.fromkeys(self.timed_out))
+        retry = partial(self._retry, read or get_metadata,
+                        self.timeout * factor)
+        recovered = {fn: meta for fn, meta in
+                     zip(filenames, map_ordered(retry, filenames, jobs))
+                     if meta is not None}
+        with self._lock:
+            self.timed_out = [fn for fn in self.timed_out
+                              if fn not in recovered]
+            self.recovered += len(recovered)
+        return recovered
+
+def _metadata_task(task):
+    """
+    Used for reading metadata in a process pool. Cached values are resolved
+    in the main process, so the task only reads the file if meta is None.
+    The time it took is returned as well, or None if the file was not read,
+    and the file_fingerprint of the file read, if fingerprint is True
+    """
+    filename, signature, meta, fingerprint = task
+    if meta is None:
+        start = time.perf_counter()
+        meta = get_metadata(filename)
+        seconds = time.perf_counter() - start
+        if fingerprint:
+            fingerprint = file_fingerprint(filename, signature[0])
+        return filename, signature, meta, seconds, fingerprint
+    return filename, signature, meta, None, None
+
+def _timed_metadata(filename, stats):
+    """ get_metadata, recording the time it takes in stats"""
+    start = time.perf_counter()
+    meta = get_metadata(filename)
+    stats.record_file(filename, time.perf_counter() - start)
+    return meta
+
+def _metadata_reader(cache=None, stats=None):
+    """ get_metadata, going through the cache and recording the statistics"""
+    read = get_metadata if stats is None \
+            else partial(_timed_metadata, stats=stats)
+    if cache is not None:
+        read = partial(cache.get_metadata, read=read)
+    return read
+
+def extract_metadata(filenames, jobs=1, processes=False, cache=None,
+                     stats=None):
+    """
+    Reads the (length, artist, title) of every file, in order, as
+    get_metadata does.
+
+    Parameters
+    ----------
+    filenames : iterable of str
+        The songs to read
+    jobs : int, optional
+        Number of songs read in parallel. The default is 1.
+    processes : bool, optional
+        Use processes instead of threads for jobs. The default is False.
+    cache : MetadataCache, optional
+        Only songs that are not in the cache are read. The default is None.
+    stats : RunStats, optional
+        Records the time each song takes to read. The default is None.
+
+    Yields
+    ------
+    (length, artist, title) : tuple
+        The metadata of each file
+
+    """
+    if not processes:
+        yield from map_ordered(_metadata_reader(cache, stats), filenames, jobs)
+        return
+    
+    #The cache and the statistics cannot be shared with other processes,
+    #so these are handled here. The fingerprints the cache needs are
+    #computed by the processes, along with the reads
+    fingerprints = cache is not None and cache.needs_fingerprints()
+    def tasks():
+        for fn in filenames:
+            if cache is None:
+                yield fn, None, None, False
+            else:
+                signature = file_signature(fn)
+                yield fn, signature, cache.lookup(fn, signature), fingerprints
+    
+    for fn, signature, meta, seconds, fingerprint in map_ordered(
+            _metadata_task, tasks(), jobs, processes):
+        if seconds is not None:
+            if cache is not None:
+                if fingerprint:
+                    cache.set_fingerprint(fn, fingerprint)
+                cache.store(fn, signature, meta)
+            if stats is not None:
+                stats.record_file(fn, seconds)
+        yield meta
+
+def map_ordered(func, items, jobs=1, processes=False):
+    """
+    Applies func to every element of items and yields the results in the
+    order of items. With more than one job the calls are fanned out to a
+    pool, but only a limited number of them are submitted ahead of the result
+    currently being yielded, so items may be an arbitrarily long iterator
+
+    Parameters
+    ----------
+    func : callable
+        Function taking a single element. Must be picklable (i.e. defined at
+        module level) if processes is True
+    items : iterable
+        The elements to process
+    jobs : int, optional
+        Number of workers. 1 or less runs func in the calling thread.
+        The default is 1.
+    processes : bool, optional
+        Use a process pool instead of a thread pool. Threads suit files on
+        slow or network drives, processes suit CPU bound tag parsing.
+        The default is False.
+
+    Yields
+    ------
+    object
+        func(item), for each item, in order
+
+    """
+    if jobs is None or jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+    
+    if processes:
+        from concurrent.futures import ProcessPoolExecutor as pool
+    else:
+        from concurrent.futures import ThreadPoolExecutor as pool
+    executor = pool(max_workers=jobs)
+    #Keeps every worker busy while the oldest result is waited for
+    window = jobs * 4
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def get_true_path(fn, input_folder, prefix):
+    """
+    Converts a path of the playlist back to the path of the file on this
+    machine, by replacing the prefix with the folder the playlist was
+    created from
+    """
+    if prefix=='':
+        return os.path.join(input_folder,fn) 
+    else:
+        return fn.replace(prefix,input_folder)
+
+@contextmanager
+def replaced_file(fn, binary = False, newline = None):
+    """
+    Opens a temporary file next to fn for writing text, or bytes if binary
+    is True, which replaces fn once it is closed. If writing fails, fn is
+    left as it was. newline is passed to open for text
+    """
+    tmp_fn = fn + '.tmp'
+    try:
+        with (open(tmp_fn, 'wb') if binary else
+              open(tmp_fn, 'w', encoding='utf-8', newline=newline)) as f:
+            yield f
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        raise
+
+def save_tracklist_to_file(tracks,input_folder,prefix,output_fn,
+                           jobs=1,processes=False,cache=None,stats=None):
+    """
+    Save a list of filenames and ? marked meta commands to the specified files,
+    adding any necessary headers and extracting the meta information for the
+    files
+
+    Parameters
+    ----------
+    tracks : iterable of str
+        The filenames. Can be a generator, e.g. iter_all_files. It is only
+        iterated once.
+    input_folder: str
+        The parent input folder
+    output_fn : str
+        the file to save to.
+    jobs : int, optional
+        Number of files whose metadata is read in parallel. The order of the
+        output is not affected. The default is 1.
+    processes : bool, optional
+        Read the metadata in separate processes instead of threads.
+        The default is False.
+    cache : MetadataCache, optional
+        Songs found in the cache are not opened. The default is None.
+    stats : RunStats, optional
+        Records the time spent walking the folder, reading the metadata and
+        writing the file. The default is None.
+
+    Returns
+    -------
+    songcount : int
+        The number of songs written
+    groupcount : int
+        The number of groups written
+
+    """
+    if stats is not None:
+        tracks = stats.timed('walk', tracks)
+    #The metadata is read ahead of the lines being written
+    tracks, ahead = tee(tracks)
+    metas = extract_metadata((get_true_path(fn, input_folder, prefix)
+                              for fn in ahead if fn[0]!='?'),
+                             jobs, processes, cache, stats)
+    if stats is not None:
+        metas = stats.timed('metadata', metas)
+    with (nullcontext() if stats is None else stats.phase('write')):
+        return write_tracklist(tracks, metas, output_fn)
+
+def write_tracklist(tracks, metas, output_fn):
+    """
+    Writes the filenames and ? marked meta commands to a playlist, with the
+    #EXTINF line of each file
+
+    Parameters
+    ----------
+    tracks : iterable of str
+        The filenames and ? marked lines
+    metas : iterator of tuple
+        The (length, artist, title) of each filename in tracks, in order
+    output_fn : str
+        the file to save to.
+
+    Returns
+    -------
+    songcount : int
+        The number of songs written
+    groupcount : int
+        The number of groups written
+
+    """
+    songcount = 0
+    groupcount = 0
+    with replaced_file(output_fn) as g:
+            #File header
+            g.write('#EXTM3U\n') 
+            for fn in tracks:
+                #? lines mark commands. These are printed as-is
+                if fn[0]=='?':
+                    g.write(fn[1:])
+                    if fn[:9]=='?#EXTGRP:':
+                        groupcount += 1
+                else:
+                    g.write(format_EXTINF(*next(metas)))
+                    g.write(fn)
+                    songcount += 1
+                g.write('\n')
+    return songcount, groupcount
+
+def save_tracklist_to_files(tracks, input_folder, targets, jobs=1,
+                            processes=False, cache=None, stats=None):
+    """
+    Saves the same songs to several playlists that only differ in their
+    prefix. The folder is walked and the metadata is read only once, and
+    the playlists are written at the same time, each by its own thread.
+
+    Parameters
+    ----------
+    tracks : iterable of str
+        The filenames relative to input_folder, without prefix, and the ?
+        marked meta commands, e.g. iter_all_files(input_folder)
+    input_folder: str
+        The parent input folder
+    targets : list of tuple
+        The (prefix, output_fn, group_title) of each playlist. If the
+        group_title is not empty, the playlist starts with that group
+    jobs, processes, cache, stats
+        See save_tracklist_to_file
+
+    Returns
+    -------
+    list of tuple
+        The (songcount, groupcount) of each playlist
+
+    """
+    if stats is not None:
+        tracks = stats.timed('walk', tracks)
+    tracks, ahead = tee(tracks)
+    metas = extract_metadata((os.path.join(input_folder, fn)
+                              for fn in ahead if fn[0]!='?'),
+                             jobs, processes, cache, stats)
+    if stats is not None:
+        metas = stats.timed('metadata', metas)
+    with (nullcontext() if stats is None else stats.phase('write')):
+        return write_tracklists(tracks, metas, targets)
+
+def _queued(q):
+    """ The elements of the batches put in q, until None is put"""
+    while True:
+        batch = q.get()
+        if batch is None:
+            return
+        yield from batch
+
+def _write_target(q, prefix, output_fn, group_title):
+    """ Writes the (filename, meta) pairs put in q as a playlist"""
+    items = _queued(q)
+    metas = deque()
+    def tracks():
+        if group_title != '':
+            yield '?#EXTGRP:' + group_title
+        for fn, meta in items:
+            if meta is None:
+                yield fn
+            else:
+                metas.append(meta)
+                yield os.path.join(prefix, fn)
+    try:
+        #The meta of each song is queued right before it is needed
+        return write_tracklist(tracks(), iter(metas.popleft, None), output_fn)
+    finally:
+        #Whatever is left is consumed, so that the other writers are not
+        #blocked by this one
+        deque(items, maxlen=0)
+
+def write_tracklists(tracks, metas, targets, batch_size=WRITE_BATCH_SIZE):
+    """
+    write_tracklist for several (prefix, output_fn, group_title) targets,
+    see save_tracklist_to_files. The songs are handed to the writer threads
+    in batches, through bounded queues, so only a few batches are in memory
+    """
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
+    queues = [queue.Queue(maxsize=4) for _ in targets]
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = [executor.submit(_write_target, q, *target)
+                   for q, target in zip(queues, targets)]
+        batch = []
+        try:
+            for fn in tracks:
+                batch.append((fn, None if fn[0]=='?' else next(metas)))
+                if len(batch) >= batch_size:
+                    for q in queues:
+                        q.put(batch)
+                    batch = []
+        finally:
+            for q in queues:
+                q.put(batch)
+                q.put(None)
+        return [future.result() for future in futures]
+
+def _with_latency(func, latency, item):
+    """ func(item), delayed as if item was on a slow network drive"""
+    if latency > 0:
+        time.sleep(latency)
+    return func(item)
+
+async def aiter_all_files(path, prefix='', extensions=EXTENSIONS,
+                          group_title='', jobs=1, latency=0, memo=None):
+    """
+    Asynchronous version of iter_all_files. The same filenames and group
+    markers are yielded in the same order, but the folders that come next
+    are listed in the background, so the round-trips to a network drive
+    overlap.
+
+    Parameters
+    ----------
+    path, prefix, extensions, group_title, memo :
+        See iter_all_files
+    jobs : int, optional
+        Number of folders listed at the same time. At most jobs * 4 folders
+        are listed ahead of the one being yielded. The default is 1.
+    latency : float, optional
+        Seconds to wait before listing each folder. Used for simulating
+        network drives in tests and benchmarks. The default is 0.
+
+    Yields
+    ------
+    str
+        See iter_all_files
+
+    """
+    import asyncio
+    jobs = max(jobs or 1, 1)
+    window = jobs * 4
+    semaphore = asyncio.Semaphore(jobs)
+    list_folder = partial(_with_latency,
+                          partial(_list_folder, extensions=extensions,
+                                  memo=memo),
+                          latency)
+    
+    async def listing(path):
+        async with semaphore:
+            return await asyncio.to_thread(list_folder, path)
+    
+    #Folders that are still to be parsed, with the task listing them
+    stack = [[path, prefix, group_title, None]]
+    try:
+        while stack:
+            #The top of the stack is parsed next
+            for item in stack[-window:]:
+                if item[3] is None:
+                    item[3] = asyncio.ensure_future(listing(item[0]))
+            path, prefix, group_title, task = stack.pop()
+            if group_title != '':
+                yield '?#EXTGRP:' + group_title
+            
+            songs, folders = await task
+            for name in songs:
+                yield os.path.join(prefix, name)
+            #Reversed, so that the first folder is popped first
+            for folder in reversed(folders):
+                stack.append([os.path.join(path,folder),
+                              os.path.join(prefix,folder),
+                              folder, None])
+    finally:
+        for item in stack:
+            if item[3] is not None:
+                item[3].cancel()
+
+async def amap_ordered(func, items, jobs=1):
+    """
+    Asynchronous version of map_ordered. func is called in threads, at most
+    jobs at a time, and the results are yielded in the order of items. Only
+    jobs * 4 items are taken ahead of the result being yielded, so a slow
+    consumer holds back the reading of items
+
+    Parameters
+    ----------
+    func : callable
+        Blocking function taking a single element
+    items : iterable or asynchronous iterable
+        The elements to process
+    jobs : int, optional
+        Number of concurrent calls. The default is 1.
+
+    Yields
+    ------
+    object
+        func(item), for each item, in order
+
+    """
+    import asyncio
+    jobs = max(jobs or 1, 1)
+    semaphore = asyncio.Semaphore(jobs)
+    #Tasks in the order of items, None marks the end
+    queue = asyncio.Queue(maxsize=jobs * 4)
+    
+    async def call(item):
+        async with semaphore:
+            return await asyncio.to_thread(func, item)
+    
+    async def produce():
+        try:
+            if hasattr(items, '__aiter__'):
+                async for item in items:
+                    await queue.put(asyncio.ensure_future(call(item)))
+            else:
+                for item in items:
+                    await queue.put(asyncio.ensure_future(call(item)))
+        except Exception:
+            #The error is raised when the producer is awaited
+            await queue.put(None)
+            raise
+        await queue.put(None)
+    
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            task = await queue.get()
+            if task is None:
+                break
+            yield await task
+        await producer
+    finally:
+        producer.cancel()
+        while not queue.empty():
+            task = queue.get_nowait()
+            if task is not None:
+                task.cancel()
+
+def _track_metadata(fn, read, input_folder, prefix):
+    """ A line of a tracklist with its metadata. None for ? marked lines"""
+    if fn[0] == '?':
+        return fn, None
+    return fn, read(get_true_path(fn, input_folder, prefix))
+
+async def save_tracklist_async(tracks, input_folder, prefix, output_fn,
+                               jobs=1, cache=None, stats=None, latency=0):
+    """
+    Asynchronous version of save_tracklist_to_file. The metadata is read in
+    threads, at most jobs at a time, and the lines are written in order as
+    soon as they are available.
+
+    Parameters
+    ----------
+    tracks : iterable or asynchronous iterable of str
+        The filenames and ? marked lines, e.g. aiter_all_files
+    input_folder, prefix, output_fn, jobs, cache, stats :
+        See save_tracklist_to_file
+    latency : float, optional
+        Seconds to wait before reading each song. Used for simulating
+        network drives in tests and benchmarks. The default is 0.
+
+    Returns
+    -------
+    songcount : int
+        The number of songs written
+    groupcount : int
+        The number of groups written
+
+    """
+    read = partial(_with_latency, _metadata_reader(cache, stats), latency)
+    songcount = 0
+    groupcount = 0
+    with replaced_file(output_fn) as g:
+        g.write('#EXTM3U\n')
+        async for fn, meta in amap_ordered(
+                partial(_track_metadata, read=read, input_folder=input_folder,
+                        prefix=prefix),
+                tracks, jobs):
+            #? lines mark commands. These are printed as-is
+            if meta is None:
+                g.write(fn[1:])
+                if fn[:9]=='?#EXTGRP:':
+                    groupcount += 1
+            else:
+                g.write(format_EXTINF(*meta))
+                g.write(fn)
+                songcount += 1
+            g.write('\n')
+    return songcount, groupcount
+
+async def extract_metadata_async(filenames, jobs=1, cache=None, stats=None,
+                                 latency=0):
+    """
+    Asynchronous version of extract_metadata. Returns the list of
+    (length, artist, title) of the files, in order. See save_tracklist_async
+    for latency
+    """
+    read = partial(_with_latency, _metadata_reader(cache, stats), latency)
+    return [meta async for meta in amap_ordered(read, filenames, jobs)]
+
+def run_async(coroutine, jobs=1):
+    """
+    Runs the coroutine in a new event loop, with enough threads for jobs
+    folders to be listed and jobs songs to be read at the same time
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    
+    async def main():
+        asyncio.get_running_loop().set_default_executor(
+                        ThreadPoolExecutor(max_workers=2 * max(jobs or 1, 1)))
+        return await coroutine
+    return asyncio.run(main())
+
+class Entry:
+    """
+    A song of a playlist. info holds the lines preceding the path, usually
+    the #EXTINF line, path is the line of the path itself
+    """
+    __slots__ = ('path', 'info')
+    
+    def __init__(self, path, info = ''):
+        self.path = path
+        self.info = info
+    
+    def lines(self):
+        if self.info != '':
+            yield self.info
+        yield self.path
+
+class Group:
+    """
+    A group of a playlist, started by an #EXTGRP: line, or by an #EXTM3U
+    line for unnamed groups, in which case the name is None. trailer holds
+    any lines after the last entry
+    """
+    __slots__ = ('name', 'entries', 'trailer')
+    
+    def __init__(self, name = None, entries = None, trailer = ''):
+        self.name = name
+        self.entries = [] if entries is None else entries
+        self.trailer = trailer
+    
+    def is_empty(self):
+        return len(self.entries) == 0 and self.trailer == ''
+    
+    def header(self):
+        if self.name is None:
+            return '#EXTM3U\n'
+        return '#EXTGRP:{}\n'.format(self.name)
+    
+    def lines(self, header = True):
+        """ Yields the lines of the group, optionally without the header"""
+        if header:
+            yield self.header()
+        for entry in self.entries:
+            yield from entry.lines()
+        if self.trailer != '':
+            yield self.trailer
+    
+    def insert(self, songs):
+        """
+        Inserts songs into the group. Every song is placed before the first
+        entry whose file name is greater in natural order, or at the end of
+        the group if there is none. The result is the same as inserting the
+        songs one by one in the given order, but the sort keys are only
+        computed once and the group is rebuilt in a single pass.
+
+        Parameters
+        ----------
+        songs : iterable of (str, Entry)
+            The file name of each song and the entry to insert for it
+
+        Returns
+        -------
+        None.
+
+        """
+        #The first entry greater than a song is the first one where the
+        #running maximum is greater, which can be searched by bisection
+        running_max = []
+        for entry in self.entries:
+            key = natural_key(os.path.basename(entry.path))
+            if running_max and running_max[-1] > key:
+                key = running_max[-1]
+            running_max.append(key)
+        
+        #(index, key, order of the song) is the order in the result
+        inserts = []
+        for order, (name, entry) in enumerate(songs):
+            key = natural_key(name)
+            inserts.append((bisect_right(running_max, key), key, order, entry))
+        inserts.sort(key = lambda insert: insert[:3])
+        
+        entries = []
+        start = 0
+        for index, _, _, entry in inserts:
+            entries.extend(self.entries[start:index])
+            entries.append(entry)
+            start = index
+        entries.extend(self.entries[start:])
+        self.entries = entries
+
+def iter_groups(lines):
+    """
+    Parses the lines of a playlist and yields the groups one by one, as soon
+    as each of them is complete. Lines before the first header form an
+    unnamed group
+
+    Parameters
+    ----------
+    lines : iterable of str
+        The lines of the playlist, e.g. an open file
+
+    Yields
+    ------
+    Group
+        The groups, in order, including empty ones
+
+    """
+    group = None
+    info = []
+    for line in lines:
+        if line[:8] == '#EXTGRP:' or line[:7] == '#EXTM3U':
+            if group is not None or info:
+                if group is None:
+                    group = Group()
+                group.trailer = ''.join(info)
+                yield group
+            info = []
+            group = Group(line[8:].rstrip('\r\n')
+                          if line[:8] == '#EXTGRP:' else None)
+        elif line[:1] == '#' or line.strip() == '':
+            info.append(line)
+        else:
+            if group is None:
+                group = Group()
+            group.entries.append(Entry(line, ''.join(info)))
+            info = []
+    if group is not None or info:
+        if group is None:
+            group = Group()
+        group.trailer = ''.join(info)
+        yield group
+
+class Playlist:
+    """
+    A parsed playlist. The first group is usually the unnamed group started
+    by the #EXTM3U header of the file
+    """
+    __slots__ = ('groups',)
+    
+    def __init__(self, groups = None):
+        self.groups = [] if groups is None else groups
+    
+    @classmethod
+    def read(cls, fn):
+        with open(fn, 'r', encoding='utf-8') as f:
+            return cls(list(iter_groups(f)))
+    
+    def remove_empty_groups(self):
+        self.groups = [group for group in self.groups if not group.is_empty()]
+    
+    def lines(self):
+        """ Yields the lines of the playlist, starting with the header"""
+        yield '#EXTM3U\n'
+        for i, group in enumerate(self.groups):
+            #The file header already starts the first unnamed group
+            yield from group.lines(header = i > 0 or group.name is not None)
+    
+    def write(self, fn):
+        with open(fn, 'w', encoding='utf-8') as f:
+            f.writelines(self.lines())
+
+class MappedPlaylist:
+    """
+    A playlist file mapped into memory. The offsets of the groups are found
+    in a single pass, without creating a string per line, and a group is
+    only parsed when it is asked for. Groups that are not modified can be
+    written from slices of the mapping, which produces the same bytes as
+    parsing and writing them with Playlist would.
+    
+    Groups are numbered as in iter_groups, including the empty ones. The
+    methods writing a list of groups expect the indices of the groups to
+    keep, in order, and a dict of the groups replaced by a Group. The index
+    None stands for a new group.
+    """
+    
+    def __init__(self, fn):
+        self._file = open(fn, 'rb')
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._buffer = mmap.mmap(self._file.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        else:
+            self._buffer = b''
+        self._view = memoryview(self._buffer)
+        #Slices are only written as-is if the line breaks are already the
+        #ones of text files on this system
+        if NEWLINE == b'\n':
+            self.plain = self._buffer.find(b'\r') == -1
+        else:
+            self.plain = self._buffer.count(b'\r') == \
+                self._buffer.count(NEWLINE) == self._buffer.count(b'\n')
+        #The start of each group, the end of its header line and its end
+        self._starts = array('q')
+        self._bodies = array('q')
+        for match in GROUP_HEADER.finditer(self._buffer):
+            if not self._starts and match.start() > 0:
+                #Lines before the first header form an unnamed group
+                self._starts.append(0)
+                self._bodies.append(0)
+            self._starts.append(match.start())
+            self._bodies.append(match.end())
+        if not self._starts and len(self._buffer) > 0:
+            self._starts.append(0)
+            self._bodies.append(0)
+        self._ends = self._starts[1:]
+        self._ends.append(len(self._buffer))
+    
+    def __len__(self):
+        return len(self._starts)
+    
+    def name(self, i):
+        """ The name of the group, as in Group"""
+        header = self._buffer[self._starts[i]:self._bodies[i]]
+        if header[:8] != b'#EXTGRP:':
+            return None
+        return header[8:].decode('utf-8').rstrip('\r\n')
+    
+    def is_empty(self, i):
+        return self._bodies[i] == self._ends[i]
+    
+    def group(self, i):
+        """ The group parsed into a Group"""
+        text = self._buffer[self._starts[i]:self._ends[i]].decode('utf-8')
+        return next(iter_groups(io.StringIO(text, newline=None)))
+    
+    def check_text(self, chunk_size = 1 << 20):
+        """
+        Decodes the whole file, one chunk at a time, raising
+        UnicodeDecodeError if it is not valid UTF-8
+        """
+        import codecs
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for start in range(0, len(self._buffer), chunk_size):
+            decoder.decode(self._view[start:start + chunk_size])
+        decoder.decode(b'', final = True)
+    
+    def lines(self, i):
+        """
+        Yields the lines of the group after its header, one at a time, as
+        str ending with '\n'
+        """
+        for match in LINE.finditer(self._buffer, self._bodies[i],
+                                   self._ends[i]):
+            yield match.group().rstrip(b'\r\n').decode('utf-8') + '\n'
+    
+    def write_group(self, f, i, header = True):
+        """
+        Writes the lines of the group to a file opened in binary mode, as
+        Group.lines would, optionally without the header
+        """
+        if not self.plain:
+            f.write(''.join(self.group(i).lines(header))
+                    .replace('\n', os.linesep).encode('utf-8'))
+            return
+        if header:
+            line = self._buffer[self._starts[i]:self._bodies[i]]
+            if line[:8] != b'#EXTGRP:':
+                #Unnamed groups get the header of Group
+                line = b'#EXTM3U' + NEWLINE
+            elif line[-1:] != b'\n':
+                line += NEWLINE
+            f.write(line)
+        body = self._view[self._bodies[i]:self._ends[i]]
+        f.write(body)
+        body.release()
+    
+    def _write(self, f, groups, changed, k, i):
+        """ Writes the group i, which is the k-th one written"""
+        #The file header already starts the first unnamed group
+        if i in changed:
+            header = k > 0 or changed[i].name is not None
+            f.write(''.join(changed[i].lines(header))
+                    .replace('\n', os.linesep).encode('utf-8'))
+        else:
+            self.write_group(f, i, k > 0 or self.name(i) is not None)
+    
+    def write(self, f, groups, changed):
+        """
+        Writes the groups to a file opened in binary mode, as Playlist.write
+        would
+        """
+        f.write(b'#EXTM3U' + NEWLINE)
+        for k, i in enumerate(groups):
+            self._write(f, groups, changed, k, i)
+    
+    def _unchanged(self, i, k, changed):
+        """
+        Whether writing the group as the k-th one, or removing it if k is
+        None, leaves the bytes of the file the same
+        """
+        if i in changed or not self.plain:
+            return False
+        header = self._buffer[self._starts[i]:self._bodies[i]]
+        if i == 0:
+            #Written after the file header, without its own
+            return header == b'#EXTM3U' + NEWLINE
+        if k is None:
+            return False
+        if header[:8] == b'#EXTGRP:':
+            return True
+        return k > 0 and header == b'#EXTM3U' + NEWLINE
+    
+    def patch(self, groups, changed, limit = PATCH_LIMIT):
+        """
+        The smallest range of the file that has to be replaced for it to be
+        the same as if the groups were written with write
+
+        Returns
+        -------
+        (start, end, data) : tuple
+            The bytes from start to end have to be replaced by data. None
+            if more than limit bytes would have to be held in memory
+
+        """
+        if None in groups:
+            return None
+        order = {i: k for k, i in enumerate(groups)}
+        modified = [i for i in range(len(self))
+                    if not self._unchanged(i, order.get(i), changed)]
+        if not modified:
+            return 0, 0, b''
+        start = self._starts[modified[0]]
+        end = self._ends[modified[-1]]
+        if end - start > limit:
+            return None
+        f = io.BytesIO()
+        if modified[0] == 0:
+            f.write(b'#EXTM3U' + NEWLINE)
+        for i in range(modified[0], modified[-1] + 1):
+            if i in order:
+                self._write(f, groups, changed, order[i], i)
+        return start, end, f.getvalue()
+    
+    def close(self):
+        self._view.release()
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+def splice_file(fn, start, end, data, buffer_size = 1 << 20):
+    """
+    Replaces the bytes from start to end of the file with data, in place.
+    The rest of the file after end is moved if the length changes, one
+    buffer at a time, so only the end of the file is written again.
+    
+    The file is not consistent while this runs, and is left corrupted if
+    it is interrupted. Only used by mode 4 with --in_place
+    """
+    with open(fn, 'r+b') as f:
+        size = f.seek(0, 2)
+        shift = len(data) - (end - start)
+        if shift > 0:
+            #Moved from the end backwards, so nothing is overwritten unread
+            pos = size
+            while pos > end:
+                count = min(buffer_size, pos - end)
+                pos -= count
+                f.seek(pos)
+                chunk = f.read(count)
+                f.seek(pos + shift)
+                f.write(chunk)
+        elif shift < 0:
+            pos = end
+            while pos < size:
+                f.seek(pos)
+                chunk = f.read(buffer_size)
+                f.seek(pos + shift)
+                f.write(chunk)
+                pos += len(chunk)
+            f.truncate(size + shift)
+        f.seek(start)
+        f.write(data)
+
+class _WatchedFolder:
+    """ A folder of a watched library, with the group of its songs"""
+    __slots__ = ('path', 'prefix', 'mtime', 'seen', 'group', 'children')
+    
+    def __init__(self, path, prefix, name):
+        self.path = path
+        self.prefix = prefix
+        #When the folder was last listed and the last time seen by a poll
+        self.mtime = None
+        self.seen = None
+        self.group = Group(name)
+        self.children = []
+    
+    def walk(self):
+        """ Yields the folder and its subfolders in the order of iter_all_files"""
+        stack = [self]
+        while stack:
+            folder = stack.pop()
+            yield folder
+            stack.extend(reversed(folder.children))
+
+class PlaylistWatcher:
+    """
+    Keeps a playlist created by mode 1 up to date with its folder. The
+    modification times of the folders are polled, which change when a song
+    or a subfolder is added, removed or renamed. Once there were no further
+    changes for the debounce time, only the changed folders are listed
+    again, and only the songs that are new in them are read.
+    
+    Songs edited in place do not change the time of their folder. These are
+    only read again if the playlist is created again.
+    """
+    
+    def __init__(self, path, prefix, output_fn, group_title='', jobs=1,
+                 processes=False, cache=None, stats=None):
+        """
+        Parameters
+        ----------
+        path, prefix, output_fn :
+            As for mode 1
+        group_title : str, optional
+            The name of the group of the songs directly in path.
+            The default is ''.
+        jobs, processes, cache, stats :
+            See extract_metadata
+
+        """
+        self.output_fn = output_fn
+        self.jobs = jobs
+        self.processes = processes
+        self.cache = cache
+        self.stats = stats
+        #Without a title, the songs of path are in the unnamed group at the
+        #start of the playlist, as in iter_all_files
+        self.root = _WatchedFolder(path, prefix, group_title or None)
+        self._last_change = None
+        #The entries of the songs that timed out, by filename
+        self._timed_out = {}
+    
+    def _list(self, folders):
+        """
+        Lists the folders again, updating their songs and subfolders. New
+        subfolders are listed recursively. Returns the number of songs read
+        """
+        to_read = []
+        stack = list(folders)
+        while stack:
+            folder = stack.pop()
+            try:
+                mtime = os.stat(folder.path).st_mtime_ns
+                songs, names = _list_folder(folder.path, EXTENSIONS)
+            except FileNotFoundError:
+                #Removed along with its parent, which is listed as well
+                continue
+            folder.mtime = folder.seen = mtime
+            
+            entries = {entry.path: entry for entry in folder.group.entries}
+            folder.group.entries = []
+            for name in songs:
+                line = os.path.join(folder.prefix, name) + '\n'
+                entry = entries.get(line)
+                if entry is None:
+                    entry = Entry(line)
+                    to_read.append((entry, os.path.join(folder.path, name)))
+                folder.group.entries.append(entry)
+            
+            children = {child.group.name: child for child in folder.children}
+            folder.children = []
+            for name in names:
+                child = children.get(name)
+                if child is None:
+                    child = _WatchedFolder(os.path.join(folder.path, name),
+                                           os.path.join(folder.prefix, name),
+                                           name)
+                    stack.append(child)
+                folder.children.append(child)
+        
+        metas = extract_metadata((fn for _, fn in to_read), self.jobs,
+                                 self.processes, self.cache, self.stats)
+        for (entry, _), meta in zip(to_read, metas):
+            entry.info = format_EXTINF(*meta)
+        
+        #Songs that timed out are read again after every listing, until
+        #they are read
+        if isinstance(self.cache, DeadlineCache) and self.cache.timed_out:
+            timed_out = set(self.cache.timed_out)
+            self._timed_out.update((fn, entry) for entry, fn in to_read
+                                   if fn in timed_out)
+            for fn, meta in self.cache.retry(self.jobs).items():
+                entry = self._timed_out.pop(fn, None)
+                if entry is not None:
+                    entry.info = format_EXTINF(*meta)
+        return len(to_read)
+    
+    def build(self):
+        """ Lists the whole folder and writes the playlist"""
+        songs = self._list([self.root])
+        self.write()
+        return songs
+    
+    def poll(self):
+        """ Checks every folder for changes. Returns the number of changes"""
+        changed = 0
+        for folder in self.root.walk():
+            try:
+                mtime = os.stat(folder.path).st_mtime_ns
+            except OSError:
+                continue
+            if mtime != folder.seen:
+                folder.seen = mtime
+                changed += 1
+        if changed:
+            self._last_change = time.monotonic()
+        return changed
+    
+    def update(self, debounce = 0):
+        """
+        Lists the changed folders again and rewrites the playlist, if no
+        changes were seen by poll for debounce seconds
+
+        Returns
+        -------
+        folders : int
+            The number of folders listed again
+        songs : int
+            The number of songs read
+
+        """
+        if self._last_change is None or \
+                time.monotonic() - self._last_change < debounce:
+            return 0, 0
+        self._last_change = None
+        folders = [folder for folder in self.root.walk()
+                   if folder.seen != folder.mtime]
+        if not folders:
+            return 0, 0
+        songs = self._list(folders)
+        self.write()
+        return len(folders), songs
+    
+    def write(self):
+        """
+        Replaces the playlist at once, so that it is never read partially.
+        The songs read are committed to the cache as well, so that it is not
+        kept locked while the folders are watched
+        """
+        playlist = Playlist([folder.group for folder in self.root.walk()])
+        playlist.write(self.output_fn + '.tmp')
+        os.replace(self.output_fn + '.tmp', self.output_fn)
+        if self.cache is not None:
+            self.cache.commit()
+    
+    def songcount(self):
+        return sum(len(folder.group.entries) for folder in self.root.walk())
+    
+    def run(self, interval = 2, debounce = 1, polls = None):
+        """
+        Polls the folders every interval seconds and updates the playlist
+        when changes settle, until interrupted or polls polls are done
+        """
+        count = 0
+        while polls is None or count < polls:
+            time.sleep(interval)
+            self.poll()
+            folders, songs = self.update(debounce)
+            if folders:
+                print('{} folders updated, {} songs read, {} songs in the '
+                      'playlist'.format(folders, songs, self.songcount()))
+            count += 1
+
+def iter_entries(lines):
+    """
+    Splits the lines of a playlist into songs. Yields (info, path) for every
+    song, info being the list of lines before its path, such as #EXTINF.
+    Group headers, and the lines after the last song of a group, are yielded
+    as (lines, None)
+    """
+    info = []
+    for line in lines:
+        if line[:8] == '#EXTGRP:' or line[:7] == '#EXTM3U':
+            if info:
+                yield info, None
+                info = []
+            yield [line], None
+        elif line[:1] == '#' or line.strip() == '':
+            info.append(line)
+        else:
+            yield info, line
+            info = []
+    if info:
+        yield info, None
+
+def _extinf_length(info):
+    """ The length in the last #EXTINF line of info, or None"""
+    for line in reversed(info):
+        if line[:8] == '#EXTINF:':
+            return line[8:].partition(',')[0].strip()
+    return None
+
+class Deduplicator:
+    """
+    Removes the songs of playlists that were already seen, keeping the first
+    occurrence. Each song is looked up once in a set of keys, so the time
+    is linear in the number of lines.
     
-    #if the file name cannot be retrieved, the file name is 
-    #used instead (default value of title)
-    artist, title = get_artist_title(meta,
-            title = os.path.splitext(
-                        os.path.basename(filename))[0])
-    #The EXTINF field only has 2 fields, {} - {} is only a 
-    #convention. If the artist cannot be retrieved, it is skipped
-    if len(artist)>0:
-        return '#EXTINF:{},{} – {}\n'.format(
-                                            length,
-                                            artist,
-                                            title)
-    else:
-        return '#EXTINF:{},{}\n'.format(
-                                        length,
-                                        title)
+    With the 'first' policy a song is only kept once in the whole output,
+    with 'group' it is kept once in every group, groups of the same name
+    counting as one. The key of a song is its normalized path, or with
+    key='tags', the length and text of its #EXTINF line, if it has one.
+    """
+    
+    def __init__(self, policy = 'first', key = 'path'):
+        if policy not in ('first', 'group') or key not in ('path', 'tags'):
+            raise ValueError("Unknown deduplication policy or key: {}, {}"
+                             .format(policy, key))
+        self.policy = policy
+        self.key = key
+        self.removed = 0
+        self._seen = set()
+        self._group = None
+        self._added = []
+    
+    def song_key(self, info, path):
+        """ The key of a song, from the lines before its path and the path"""
+        if self.key == 'tags':
+            for line in reversed(info):
+                if line[:8] == '#EXTINF:':
+                    length, _, text = line[8:].rstrip('\r\n').partition(',')
+                    return 'tags', length.strip(), text.strip().casefold()
+        #The same file can be written with either kind of separator
+        path = posixpath.normpath(path.strip().replace('\\', '/'))
+        return 'path', os.path.normcase(path)
+    
+    def filter(self, lines):
+        """ Yields the lines, without those of the repeated songs"""
+        for info, line in iter_entries(lines):
+            if line is None:
+                if info[0][:8] == '#EXTGRP:':
+                    self._group = info[0][8:].rstrip('\r\n')
+                elif info[0][:7] == '#EXTM3U':
+                    self._group = None
+                yield from info
+                continue
+            key = self.song_key(info, line)
+            if self.policy == 'group':
+                key = (self._group,) + key
+            if key in self._seen:
+                self.removed += 1
+            else:
+                self._seen.add(key)
+                self._added.append(key)
+                yield from info
+                yield line
+    
+    def commit(self):
+        """ Keeps the songs seen since the last commit"""
+        self._added = []
+    
+    def rollback(self):
+        """ Forgets the songs seen since the last commit"""
+        self._seen.difference_update(self._added)
+        self._added = []
 
-def save_tracklist_to_file(tracks,input_folder,prefix,output_fn):
+def merge_playlists(fns, fn_out, buffer_size = 1 << 20, dedup = None):
     """
-    Save a list of filenames and ? marked meta commands to the specified files,
-    adding any necessary headers and extracting the meta information for the
-    files
+    Concatenates playlists into a single file. The songs at the beginning of
+    a playlist that are not in a group are put into a group named after the
+    file, except for the first playlist.
+    
+    The files are copied to the output in large chunks, so the memory used
+    does not depend on their size. If a file other than the first cannot be
+    read, a message is printed and whatever was written from it is removed.
 
     Parameters
     ----------
-    tracks : str
-        A list of filenames.
-    input_folder: str
-        The parent input folder
-    output_fn : str
-        the file to save to.
+    fns : list of str, path
+        The playlists to merge, in order
+    fn_out : str, path
+        The output file
+    buffer_size : int, optional
+        The size of the chunks that are copied. The default is 1 << 20.
+    dedup : Deduplicator, optional
+        If specified, the files are copied line by line through it, removing
+        the repeated songs. The default is None.
 
     Returns
     -------
     None.
 
     """
-    with open(output_fn,'w', encoding="utf-8") as g:
-            #File header
-            g.write('#EXTM3U\n') 
-            for fn in tracks:
-                #? lines mark commands. These are printed as-is
-                if fn[0]=='?':
-                    g.write(fn[1:])
-                else:
-                    if prefix=='':
-                        true_path = os.path.join(input_folder,fn) 
+    with open(fn_out, 'w', encoding='utf-8', buffering=buffer_size) as out:
+        out.write('#EXTM3U\n')
+        for i, fn in enumerate(fns):
+            start = out.tell()
+            try:
+                with open(fn, 'r', encoding='utf-8',
+                          buffering=buffer_size) as src:
+                    line = src.readline()
+                    #The header of each file is replaced by the one above
+                    if line[:7] == '#EXTM3U':
+                        line = src.readline()
+                    head = [line]
+                    if i > 0 and line != '' and line[:8] != '#EXTGRP:' \
+                            and line[:7] != '#EXTM3U':
+                        head.insert(0, '#EXTGRP:{}\n'.format(
+                                os.path.splitext(os.path.basename(fn))[0]))
+                    if dedup is None:
+                        out.writelines(head)
+                        last = line
+                        line = src.read(buffer_size)
+                        while line != '':
+                            out.write(line)
+                            last = line
+                            line = src.read(buffer_size)
                     else:
-                        true_path = fn.replace(prefix,input_folder)
-                    
-                    g.write(get_EXTINF(true_path))
-                    g.write(fn)
-                g.write('\n')
+                        last = ''
+                        for line in dedup.filter(chain(head, src)):
+                            out.write(line)
+                            last = line
+                        dedup.commit()
+                    #The next file must start on a new line
+                    if last != '' and last[-1] != '\n':
+                        out.write('\n')
+            except Exception as e:
+                if i == 0:
+                    raise
+                print("Could not read from file: {}".format(e))
+                out.seek(start)
+                out.truncate()
+                if dedup is not None:
+                    dedup.rollback()
+
+def _find_files(entries, input_folder, prefix):
+    """
+    Converts the paths of a batch of (position, path, length) entries back
+    with get_true_path, and adds whether each of them is an existing file
+    """
+    found = []
+    for position, path, length in entries:
+        true_path = get_true_path(path, input_folder, prefix)
+        found.append((position, path, length, true_path,
+                      os.path.isfile(true_path)))
+    return found
 
-def split_merged_playlist(merged):
+def verify_playlist(fn, input_folder, prefix, jobs=1, check_lengths=False,
+                    cache=None, stats=None, batch_size=VERIFY_BATCH_SIZE):
     """
-    Split a merged playlist into separate files. #EXTM3U and #EXTGRP: markers
-    are used to determine splits. Empty groups are discarded
+    Checks that the songs of a playlist exist. The paths are converted back
+    with get_true_path, as when the playlist was created, and are stat-ed
+    in batches, on jobs threads, while the rest of the playlist is read.
+    Only the songs being checked are held in memory.
 
     Parameters
     ----------
-    merged : list of strings
-        a list containing the contents of a playlist file
+    fn : str, path
+        The playlist
+    input_folder : str, path
+        The folder the playlist was created from
+    prefix : str
+        The prefix the playlist was created with
+    jobs : int, optional
+        Number of batches checked in parallel. The default is 1.
+    check_lengths : bool, optional
+        Also read the songs that exist and compare their length with the
+        one in their #EXTINF line. Songs without a length, or with the
+        unknown length -1, are not read. The default is False.
+    cache : MetadataCache, optional
+        Used when the lengths are checked. The default is None.
+    stats : RunStats, optional
+        Records the time it takes to read the songs. The default is None.
+    batch_size : int, optional
+        The number of files stat-ed by a task. The default is
+        VERIFY_BATCH_SIZE.
 
     Returns
     -------
-    split : dict
-        keys are the name of the groups,
-    groupcount : int
-        number of non-emtyp groups
-    unnamed_group_tag: str
-        The prefix that denotes the separation of the sections
+    songcount : int
+        The number of songs in the playlist
+    missing : list of (int, str)
+        The position and the path, as written in the playlist, of the songs
+        whose file does not exist
+    stale : dict
+        The path and the (length, artist, title) of the songs whose #EXTINF
+        length is wrong, by position
 
     """
+    songcount = 0
+    def batches():
+        nonlocal songcount
+        batch = []
+        with open(fn, 'r', encoding='utf-8') as f:
+            for info, path in iter_entries(f):
+                if path is not None:
+                    batch.append((songcount, path.rstrip('\r\n'),
+                                  _extinf_length(info) if check_lengths
+                                  else None))
+                    songcount += 1
+                    if len(batch) == batch_size:
+                        yield batch
+                        batch = []
+        if batch:
+            yield batch
+    
+    missing = []
+    def present():
+        find = partial(_find_files, input_folder=input_folder, prefix=prefix)
+        for found in map_ordered(find, batches(), jobs):
+            for position, path, length, true_path, exists in found:
+                if not exists:
+                    missing.append((position, path))
+                elif length is not None and length != '-1':
+                    yield position, path, length, true_path
+    
+    stale = {}
+    if not check_lengths:
+        for _ in present():
+            pass
+        return songcount, missing, stale
+    
+    #The songs are read while the later ones are still being stat-ed
+    songs, ahead = tee(present())
+    metas = extract_metadata((song[3] for song in ahead), jobs,
+                             cache=cache, stats=stats)
+    for (position, path, length, _), meta in zip(songs, metas):
+        if length != str(meta[0]):
+            stale[position] = (path, meta)
+    return songcount, missing, stale
 
-    unnamed_group_tag = '__UNNAMED_GROUP_123?x_'    
-    groupcount = 0
-    split = {}
+def prune_playlist(fn, missing, stale = None):
+    """
+    Removes the missing songs from a playlist, and replaces the #EXTINF
+    lines of the songs in stale, as returned by verify_playlist. The
+    playlist is written to a temporary file first, which then replaces it.
+    Line breaks are kept as they are
+    """
+    missing = {position for position, _ in missing}
+    stale = stale or {}
+    position = 0
+    #The playlist is closed before it is replaced
+    with replaced_file(fn, newline='') as out, \
+            open(fn, 'r', encoding='utf-8', newline='') as src:
+        for info, path in iter_entries(src):
+            if path is not None:
+                position += 1
+                if position - 1 in missing:
+                    continue
+                if position - 1 in stale:
+                    _, meta = stale[position - 1]
+                    k = max(i for i, line in enumerate(info)
+                            if line[:8] == '#EXTINF:')
+                    ending = info[k][len(info[k].rstrip('\r\n')):]
+                    info[k] = format_EXTINF(*meta).rstrip('\n') + ending
+                info.append(path)
+            out.writelines(info)
 
-    for line in merged:
-        if line[:8] == '#EXTGRP:' or line[:7] == '#EXTM3U':
-            split_sublist = []
-            groupcount += 1
-            if line[:8] == '#EXTGRP:':
-                split[line[8:]] = split_sublist
-            #Unnamed groups are marked with a name that is unlikely to be used
-            elif line[:7] == '#EXTM3U':
-                split[unnamed_group_tag + str(groupcount)] =  split_sublist
-        else:
-            split_sublist.append(line)
-    
-    #Remove empty groups
-    to_remove = []
-    for key,val in split.items():
-        if val == []:
-            to_remove.append(key)
-            groupcount -= 1
-    for key in to_remove:
-        split.pop(key)
-    
-    return split, groupcount, unnamed_group_tag
-
-def reconstruct_merged_playlist(split,unnamed_group_tag):
-    merged = ['#EXTM3U\n']
-    for key, val in split.items():
-        if key[:len(unnamed_group_tag)] == unnamed_group_tag:
-            merged.append('#EXTM3U')
-        else:
-            merged.append('#EXTGRP:{}'.format(key))
-        for line in val:
-            merged.append(line)
-    return merged
+def refresh_playlist_metadata(fn, input_folder, prefix, metas):
+    """
+    Replaces the #EXTINF lines of the songs of a playlist that are in metas,
+    a dict of (length, artist, title) by filename. The paths are converted
+    with get_true_path. Returns the number of songs updated
+    """
+    stale = {}
+    with open(fn, 'r', encoding='utf-8') as f:
+        position = 0
+        for info, path in iter_entries(f):
+            if path is None:
+                continue
+            path = path.rstrip('\r\n')
+            meta = metas.get(get_true_path(path, input_folder, prefix))
+            if meta is not None and _extinf_length(info) is not None:
+                stale[position] = (path, meta)
+            position += 1
+    if stale:
+        prune_playlist(fn, [], stale)
+    return len(stale)
+
+def _iter_run(playlist, groups, disorder):
+    """
+    The (key, info, path) of the songs in the groups of a MappedPlaylist,
+    key being the natural_key of the file name. Songs that are smaller than
+    the one before them are counted in disorder[0]
+    """
+    previous = None
+    lines = chain.from_iterable(playlist.lines(i) for i in groups)
+    for info, path in iter_entries(lines):
+        if path is None:
+            continue
+        name = path.rstrip('\r\n').replace('\\', '/').rpartition('/')[2]
+        key = natural_key(name)
+        if previous is not None and key < previous:
+            disorder[0] += 1
+        previous = key
+        yield key, info, path
+
+def merge_sorted_playlists(fns, fn_out, groups = False, dedup = None):
+    """
+    Merges playlists whose songs are in natural order of their file names,
+    as in str_smaller_win, into a single sorted list without groups. The
+    playlists, or each of their groups, are merged with a heap, reading one
+    song of each at a time, so the memory used depends on the number of
+    playlists and not their size. The #EXTINF and other lines before a song
+    are kept with it. Songs of the same name keep the order of fns.
+    
+    The playlists are checked to be valid UTF-8 before the output is
+    written. As in merge_playlists, those that cannot be read are left out
+    with a message, except for the first one. The output replaces fn_out
+    once it is complete.
+
+    Parameters
+    ----------
+    fns : list of str, path
+        The playlists to merge
+    fn_out : str, path
+        The output file
+    groups : bool, optional
+        Each group is sorted on its own, rather than the whole playlist.
+        The songs of all the groups are still merged into a single list.
+        The default is False.
+    dedup : Deduplicator, optional
+        Removes the repeated songs. The default is None.
+
+    Returns
+    -------
+    songcount : int
+        The number of songs written
+    disorder : int
+        The number of songs that were not in order in their playlist. If
+        it is not 0, the result is not sorted either
+
+    """
+    disorder = [0]
+    songcount = 0
+    with ExitStack() as stack:
+        runs = []
+        for i, fn in enumerate(fns):
+            try:
+                playlist = stack.enter_context(MappedPlaylist(fn))
+                playlist.check_text()
+            except (OSError, UnicodeDecodeError) as e:
+                if i == 0:
+                    raise
+                print("Could not read from file: {}".format(e))
+                continue
+            if groups:
+                runs.extend(_iter_run(playlist, [k], disorder)
+                            for k in range(len(playlist)))
+            else:
+                runs.append(_iter_run(playlist, range(len(playlist)),
+                                      disorder))
+        try:
+            #Only the keys are compared, so that equal songs stay in order
+            lines = chain(['#EXTM3U\n'], chain.from_iterable(
+                            info + [path] for _, info, path in
+                            heapq.merge(*runs, key=itemgetter(0))))
+            if dedup is not None:
+                lines = dedup.filter(lines)
+            with replaced_file(fn_out) as out:
+                for line in lines:
+                    if line[:1] != '#' and line.strip() != '':
+                        songcount += 1
+                    out.write(line)
+        finally:
+            #The runs hold on to the mapped files until they are closed
+            for run in runs:
+                run.close()
+    return songcount, disorder[0]
 
 def sanitize_fn(fn):
     """ Sanitizes Filename. Removes beginning and trailing quotes"""
@@ -289,12 +3023,158 @@ def input_fn(prompt):
     else:
         return sanitize_fn(ip)
 
+@lru_cache(maxsize=NATURAL_KEY_CACHE_SIZE)
+def natural_key(text):
+    """
+    Sort key that orders the numbers in text by value, ignoring case. The
+    keys of the most recently used names are cached. Only ASCII digits
+    count as numbers, other digits are compared as text
+    """
+    #The split alternates text and numbers, starting with text
+    return tuple(int(c) if i % 2 else c.lower()
+                 for i, c in enumerate(NATURAL_SPLIT.split(text)))
+
+def natural_sorted(names):
+    """
+    The names in natural order. Names that only differ in case are ordered
+    by code point, so that the order does not depend on the file system
+    """
+    return sorted(names, key = lambda name: (natural_key(name), name))
+
 def str_smaller_win(str1,str2):
-    convert = lambda text: int(text) if text.isdigit() else text.lower() 
-    alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key)]
-    return alphanum_key(str1)<alphanum_key(str2)
+    return natural_key(str1)<natural_key(str2)
+
+def open_tag_cache(playlist_fn, args = None, memo = None):
+    """
+    Opens the tag cache belonging to the playlist, according to the command
+    line arguments. Returns an object usable in a with statement, which gives
+    None if the cache is disabled. With the memo of a batch, the metadata
+    already read by the other jobs is used as well
+    """
+    if getattr(args, 'no_cache', False):
+        cache = nullcontext()
+    else:
+        cache_fn = getattr(args, 'cache_fn', None)
+        cache = TagCache(cache_fn or default_cache_fn(playlist_fn),
+                         max_entries = getattr(args, 'cache_size', 1000000),
+                         rebuild = getattr(args, 'rebuild_cache', False))
+    if memo is not None:
+        return memo.cache(cache)
+    return cache
+
+def _job_files(args):
+    """
+    The files a job uses, and the files or folders it writes, including the
+    playlist pruned by mode 8. The tag cache of the job counts as written,
+    so jobs sharing one do not run at the same time
+    """
+    paths = getattr(args, 'path', None) or []
+    outputs = [getattr(args, 'output_fn', None)]
+    outputs.extend(fn for _, fn in getattr(args, 'target', None) or [])
+    if args.mode == 8 and paths and getattr(args, 'prune', False):
+        outputs.append(paths[0])
+    playlist_fn = {1: outputs[0], 4: outputs[0],
+                   8: paths[0] if paths and getattr(args, 'check_lengths',
+                                                     False) else None
+                   }.get(args.mode)
+    if playlist_fn and not getattr(args, 'no_cache', False):
+        outputs.append(getattr(args, 'cache_fn', None)
+                       or default_cache_fn(playlist_fn))
+    written = {os.path.abspath(fn) for fn in outputs if fn}
+    return {os.path.abspath(fn) for fn in paths} | written, written
+
+def _overlap(paths, others):
+    """
+    Whether one of the paths is one of the others, or inside one of them,
+    or the other way round. The paths are absolute
+    """
+    return any(path == other
+               or path.startswith(os.path.join(other, ''))
+               or other.startswith(os.path.join(path, ''))
+               for path in paths for other in others)
+
+def read_jobs(jobs_fn):
+    """
+    Parses a job file. Each line holds the command line arguments of a job,
+    e.g. -mode 1 -path Music/Rock -output_fn Rock.m3u. Empty lines and lines
+    starting with # are skipped
+
+    Returns
+    -------
+    jobs : list of (str, argparse.Namespace)
+        The line and the arguments of each job
+
+    """
+    import shlex
+    parser = build_parser()
+    jobs = []
+    with open(jobs_fn, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line[0] == '#':
+                continue
+            args = parser.parse_args(shlex.split(line))
+            if args.mode is None or args.mode == 7 or args.watch:
+                raise SystemExit("Jobs need a -mode other than 7 and cannot "
+                                 "use --watch: " + line)
+            jobs.append((line, args))
+    return jobs
+
+def run_batch(jobs, workers=1):
+    """
+    Runs the jobs in this process, sharing the folder listings and the read
+    metadata between them. Up to workers jobs run at the same time. A job
+    waits for the earlier jobs that write a file it uses, or use a file it
+    writes, and is skipped if one of them failed. A folder counts as used
+    or written along with everything in it, e.g. the output of mode 3
+
+    Parameters
+    ----------
+    jobs : list of (str, argparse.Namespace)
+        See read_jobs
+    workers : int, optional
+        The number of jobs run at the same time. The default is 1.
+
+    Returns
+    -------
+    failed : int
+        The number of jobs that failed or were skipped
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    memo = BatchMemo()
+    
+    def run(number, line, args, dependencies):
+        for other, dependency in dependencies:
+            if dependency.result():
+                print('Job {} skipped, because job {} did not finish'
+                      .format(number, other))
+                return True
+        print('Job {}: {}'.format(number, line))
+        try:
+            execute_main(True, args, memo)
+        except (Exception, SystemExit) as e:
+            print('Job {} failed: {}'.format(number, e))
+            return True
+        return False
+    
+    futures = []
+    with ThreadPoolExecutor(max_workers=max(workers or 1, 1)) as executor:
+        for number, (line, args) in enumerate(jobs, 1):
+            used, written = _job_files(args)
+            #Earlier jobs are submitted first, so they have already
+            #started by the time a job waits for them
+            dependencies = [(other, future) for other, future,
+                            other_used, other_written in futures
+                            if _overlap(written, other_used)
+                            or _overlap(used, other_written)]
+            futures.append((number,
+                            executor.submit(run, number, line, args,
+                                            dependencies),
+                            used, written))
+    return sum(future.result() for _, future, _, _ in futures)
 
-def execute_main(console_mode, args = None):
+def execute_main(console_mode, args = None, memo = None):
     CONSOLE_MODE = console_mode
     if CONSOLE_MODE:
         choice = args.mode
@@ -303,7 +3183,12 @@ def execute_main(console_mode, args = None):
                            'Hint: The program can also be run via command line '
                            'parameter for repeated tasks. Start the program with '
                            'the --help parameter for details'
-                            'Press a key:\n' + mode_tooltip))
+                            'Press a key:\n' + MODE_TOOLTIP))
+    
+    stats = None
+    if getattr(args, 'stats', False) or getattr(args, 'stats_fn', None):
+        stats = RunStats()
+        start = time.perf_counter()
     
     # Create
     if choice == 1:
@@ -321,62 +3206,166 @@ def execute_main(console_mode, args = None):
             
             output_fn = input_fn("Please specify save filename.\n")
         
+        #Further playlists of the same songs, with other prefixes
+        targets = [tuple(target) for target in
+                   getattr(args,'target',None) or []]
+        if not output_fn and targets:
+            prefix, output_fn = targets.pop(0)
+        
         if len(output_fn)<1:
             raise ValueError("The output path must be specified")
         if len(path)<1:
             path = os.path.dirname(path)
         
-        fns = get_all_files(path,prefix,
-                 group_title = os.path.splitext(
-                     os.path.basename(output_fn))[0],
-                 extensions= EXTENSIONS)
-        save_tracklist_to_file(fns,path,prefix,output_fn)
-        
-        groupcount = sum([1 if fn[:9]=='?#EXTGRP:' in fn else 0 for fn in fns])
-        songcount = len(fns) - groupcount
-        
-        print('{} songs in {} groups have been saved to file'
-                      .format(songcount,groupcount))
+        jobs = getattr(args,'jobs',1)
+        asynchronous = getattr(args,'asynchronous',False)
+        latency = getattr(args,'latency',0)
+        group_title = os.path.splitext(os.path.basename(output_fn))[0]
+        if targets and (asynchronous or getattr(args,'watch',False)):
+            raise SystemExit("-target cannot be used with --asynchronous "
+                             "or --watch")
+        with open_tag_cache(output_fn, args, memo) as cache:
+            changes = None
+            if getattr(args,'incremental',False):
+                #Read before the playlist is overwritten
+                changes = cache = PlaylistCache(output_fn, path, prefix,
+                                                inner=cache)
+            deadline = None
+            if getattr(args,'timeout',None):
+                deadline = cache = DeadlineCache(args.timeout, inner=cache,
+                                                 jobs=jobs)
+            if getattr(args,'watch',False):
+                watcher = PlaylistWatcher(path, prefix, output_fn,
+                                   group_title, jobs,
+                                   getattr(args,'processes',False),
+                                   cache, stats)
+                watcher.build()
+                songcount = watcher.songcount()
+                groupcount = sum(1 for _ in watcher.root.walk())
+            elif asynchronous:
+                #Listing, stat and tag reads overlap, so the phases are not
+                #measured separately
+                fns = aiter_all_files(path, prefix, EXTENSIONS, group_title,
+                                      jobs, latency, memo)
+                with (nullcontext() if stats is None
+                      else stats.phase('pipeline')):
+                    songcount, groupcount = run_async(
+                            save_tracklist_async(fns, path, prefix, output_fn,
+                                                 jobs, cache, stats, latency),
+                            jobs)
+            elif targets:
+                fns = iter_all_files(path, extensions = EXTENSIONS,
+                                     memo = memo)
+                targets.insert(0, (prefix, output_fn))
+                counts = save_tracklist_to_files(fns, path,
+                           [(target_prefix, target_fn, os.path.splitext(
+                                   os.path.basename(target_fn))[0])
+                            for target_prefix, target_fn in targets],
+                           jobs=jobs,
+                           processes=getattr(args,'processes',False),
+                           cache=cache, stats=stats)
+                songcount, groupcount = counts[0]
+            else:
+                fns = iter_all_files(path,prefix,
+                                     group_title = group_title,
+                                     extensions= EXTENSIONS, memo = memo)
+                songcount, groupcount = save_tracklist_to_file(fns,path,
+                                   prefix,output_fn,
+                                   jobs=jobs,
+                                   processes=getattr(args,'processes',False),
+                                   cache=cache, stats=stats)
+            
+            #The songs that timed out are read again once the others are
+            #written, and their lines are corrected. The watcher does this
+            #itself
+            if deadline is not None and deadline.timed_out \
+                    and not getattr(args,'watch',False):
+                recovered = deadline.retry(jobs)
+                for target_prefix, target_fn in targets or [(prefix,
+                                                             output_fn)]:
+                    refresh_playlist_metadata(target_fn, path, target_prefix,
+                                              recovered)
+            if stats is not None:
+                stats.count('songs', songcount)
+                stats.count_cache(cache)
+            
+            print('{} songs in {} groups have been saved to file'
+                          .format(songcount,groupcount))
+            if targets:
+                print('The playlist has been saved to {} files'
+                      .format(len(targets)))
+            if changes is not None:
+                print('{} songs added, {} removed, {} updated'
+                      .format(changes.added, changes.removed,
+                              changes.updated))
+            if deadline is not None and (deadline.timed_out
+                                         or deadline.recovered):
+                print('{} songs timed out, {} of them were read on retry'
+                      .format(len(deadline.timed_out) + deadline.recovered,
+                              deadline.recovered))
+            if getattr(args,'watch',False):
+                print('Watching {} for changes. Press Ctrl+C to stop'
+                      .format(path))
+                try:
+                    watcher.run(getattr(args,'interval',2),
+                                getattr(args,'debounce',1))
+                except KeyboardInterrupt:
+                    pass
     
     # Merge
     elif choice == 2:
         if CONSOLE_MODE:
             fns = args.path
-            fn = fns[0]
-            fn_idx = 1
         else:
-            fn = input_fn("Enter the file name of the first playlist to be "
+            fns = [input_fn("Enter the file name of the first playlist to be "
                           "merged.\n Pressing enter on an empty line will "
                           "finish collecting the paths and prompt "
-                          "for the save file name\n")
-        
-        merged = open(fn, 'r', encoding='utf').readlines()
-        
-        while True:
-            if CONSOLE_MODE:
-                if fn_idx>= len(fns):
-                    break
-                fn = fns[fn_idx]
-                fn_idx +=1
-            else:
+                          "for the save file name\n")]
+            while True:
                 fn = input_fn("Enter next file name:\n")
                 if fn == '':
                     break
-
-            try:
-                partial = open(fn, 'r', encoding='utf').readlines()
-                if partial[1][:8] != '#EXTGRP:':
-                    merged.append('#EXTGRP:{}\n'.format(os.path.splitext(
-                                            os.path.basename(fn))[0]))
-                merged += partial[1:]
-            except Exception as e:
-                print("Could not read from file: {}".format(e))
+                fns.append(fn)
         
         if CONSOLE_MODE:
             fn_out = args.output_fn
         else:
             fn_out = input_fn("Enter output playlist filename:\n")
-        open(fn_out,'w',encoding='utf-8').writelines(merged)
+        
+        if CONSOLE_MODE:
+            policy = getattr(args,'dedup',None)
+        else:
+            policy = input("Remove the repeated songs? Type first to keep "
+                           "them only once, \ngroup to keep them once in "
+                           "each group, or leave empty to keep all\n")
+        if CONSOLE_MODE:
+            runs = getattr(args,'sorted',None)
+        else:
+            runs = input("Merge the songs in natural order? Type playlists "
+                         "if the songs \nof each playlist are sorted, groups "
+                         "if the songs of each group are, \nor leave empty "
+                         "to add the playlists one after the other\n")
+            if runs not in ('', 'playlists', 'groups'):
+                raise SystemExit("Invalid order specified")
+        dedup = None
+        if policy:
+            dedup = Deduplicator(policy, getattr(args,'dedup_key','path'))
+        if runs:
+            songcount, disorder = merge_sorted_playlists(fns, fn_out,
+                                                runs == 'groups', dedup)
+            if disorder:
+                print('{} songs were not in order in their {}, so the '
+                      'result is not fully sorted'.format(disorder,
+                                                          runs[:-1]))
+        else:
+            merge_playlists(fns, fn_out, dedup = dedup)
+        if dedup is not None:
+            print('{} repeated songs have been removed'
+                  .format(dedup.removed))
+        if stats is not None:
+            stats.count('bytes_of_playlists_read',
+                        sum(os.path.getsize(fn) for fn in fns
+                            if os.path.isfile(fn)))
            
         print('Playlist succesfully saved')
     # Split
@@ -386,39 +3375,43 @@ def execute_main(console_mode, args = None):
             output_dir = args.output_fn
         else:
             fn = input_fn("Enter the filename of the playlist to split:\n")
-            output_dir = input_fn('{} groups have been found. Type in a folder to output the '
-                  'playlists to\n'.format(groupcount))
-        
-        merged = open(fn, 'r', encoding='utf-8').readlines()
-        split, groupcount, unnamed_group_tag = split_merged_playlist(merged)
+            output_dir = input_fn('Type in a folder to output the '
+                  'playlists to\n')
         
         subcount = 1
-        for sublist_name, sublist_elements in split.items():
-            if sublist_name[:len(unnamed_group_tag)] \
-                            == unnamed_group_tag:
-                #Save unnamed groups with a more friendly name
-                out_filename = 'Group {}'.format(subcount)
-                subcount += 1
-            else:
-                out_filename = sublist_name.rstrip()
-            
-            out_filename = os.path.join(output_dir,out_filename+'.m3u')    
-            # Warn if file exists
-            if os.path.exists(out_filename):
-                if CONSOLE_MODE:
-                    if not args.overwrite:
-                        continue
+        #The groups are written from slices of the mapped file, without
+        #parsing their lines
+        with MappedPlaylist(fn) as playlist:
+            for i in range(len(playlist)):
+                if playlist.is_empty(i):
+                    continue
+                name = playlist.name(i)
+                if name is None:
+                    #Save unnamed groups with a more friendly name
+                    out_filename = 'Group {}'.format(subcount)
+                    subcount += 1
                 else:
-                    answer = input("File <<{}>> already exists. Overwrite? (y/n)\n"
-                                   .format(out_filename))
-                    if len(answer)<1 or answer[0].lower() != 'y':
-                        continue
-                
-            # Add header and output contents. Group is removed and is in filename
-            with open(out_filename,'w', encoding='utf-8') as out_file:
-                out_file.write('#EXTM3U\n')
-                out_file.writelines(sublist_elements)
+                    out_filename = name.rstrip()
+            
+                out_filename = os.path.join(output_dir,out_filename+'.m3u')    
+                # Warn if file exists
+                if os.path.exists(out_filename):
+                    if CONSOLE_MODE:
+                        if not args.overwrite:
+                            continue
+                    else:
+                        answer = input("File <<{}>> already exists. Overwrite? (y/n)\n"
+                                       .format(out_filename))
+                        if len(answer)<1 or answer[0].lower() != 'y':
+                            continue
                 
+                # Add header and output contents. Group is removed and is in filename
+                with open(out_filename,'wb') as out_file:
+                    out_file.write(b'#EXTM3U' + NEWLINE)
+                    playlist.write_group(out_file, i, header = False)
+        
+        if stats is not None:
+            stats.count('bytes_of_playlists_read', os.path.getsize(fn))
         print('Files Saved')
         
     elif choice == 4:
@@ -432,7 +3425,7 @@ def execute_main(console_mode, args = None):
         if os.path.exists(fn_to_append) and os.path.isfile(fn_to_append):
             fn_list = [fn_to_append]
         elif os.path.exists(fn_to_append) and os.path.isdir(fn_to_append):
-            fn_list = os.listdir(fn_to_append)
+            fn_list = natural_sorted(os.listdir(fn_to_append))
             fn_list = [os.path.join(fn_to_append,f_s) for f_s in fn_list]
         else:
             raise SystemExit("Invalid file specified")
@@ -446,68 +3439,242 @@ def execute_main(console_mode, args = None):
     
             fn_to_mod = input_fn("Enter playlist to insert into:\n")
 
-        merged = open(fn_to_mod, 'r', encoding='utf-8').readlines()
-        split, groupcount, unnamed_group_tag = split_merged_playlist(merged)
-        
-
-        if groupcount>1:
-            if not CONSOLE_MODE:
-                print("There are {} groups in the selected file. "
-                  "Please select which group to add to:".format(groupcount))
-            idx_to_group = {}
-            for idx,group in enumerate(split.keys()):
-                idx_to_group[idx] = group
+        #Only the target group is parsed, the others are copied from the
+        #mapped file. Empty groups are removed. A new playlist replaces the
+        #old one once the mapped file is closed
+        with ExitStack() as replacing, MappedPlaylist(fn_to_mod) as playlist:
+            groups = [i for i in range(len(playlist))
+                      if not playlist.is_empty(i)]
+            if not groups:
+                groups.append(None)
+            groupcount = len(groups)
+    
+            if groupcount>1:
                 if not CONSOLE_MODE:
-                    if group[:len(unnamed_group_tag)] == unnamed_group_tag:
-                        print('{}. Unnamed group {}'.format(idx, 
-                                            group[len(unnamed_group_tag):]
-                                            .rstrip()))
+                    print("There are {} groups in the selected file. "
+                      "Please select which group to add to:"
+                      .format(groupcount))
+                    for idx,i in enumerate(groups):
+                        name = playlist.name(i)
+                        if name is None:
+                            print('{}. Unnamed group'.format(idx))
+                        else:
+                            print('{}. {}'.format(idx,name.rstrip()))
+                    
+                try:
+                    if CONSOLE_MODE:
+                        idx = args.target_group
                     else:
-                        print('{}. {}'.format(idx,group.rstrip()))
-                
-            try:
-                if CONSOLE_MODE:
-                    idx = args.target_group
-                else:
-                    idx = int(input())
-            except:
+                        idx = int(input())
+                except:
+                    raise SystemExit("Invalid number specified")
+            else:
+                print('There is only a single group in the file. Inserting')
+                idx = 0
+            if not 0 <= idx < groupcount:
                 raise SystemExit("Invalid number specified")
-        else:
-            print('There is only a single group in the file. Inserting')
-            idx = 0
-            #Creates a dictionary with a single entry that is the first group
-            idx_to_group = {0:list(split.values())[0]}
-        
-        inserted_songs = []
-        if idx in idx_to_group:
-            target_group = split[idx_to_group[idx]]
-            for f in fn_list:
-                if os.path.splitext(f)[-1][1:].lower() in EXTENSIONS:
-                    f_basename = os.path.basename(f)
-                    for i,v in enumerate(target_group):
-                        if v[:4] != '#EXT' and \
-                        str_smaller_win(f_basename,os.path.basename(v)):
-                            break;
-                    else:
-                        i+=2
-                    target_group.insert(i-1,os.path.join(fn_prefix,
-                                                    os.path.basename(f))+'\n')
-                    target_group.insert(i-1,get_EXTINF(f))
-                    inserted_songs.append(os.path.basename(f))
-                    
-            merged_new = reconstruct_merged_playlist(split, unnamed_group_tag)
             
-            open(fn_to_mod,'w',encoding='utf-8').writelines(merged_new)
-            print("{} songs have been inserted into the playlist:"
-                                  .format(len(inserted_songs)))
-            for song in inserted_songs:
-                print(song)
+            inserted_songs = []
+            songs = [f for f in fn_list
+                     if os.path.splitext(f)[-1][1:].lower() in EXTENSIONS]
+            jobs = getattr(args,'jobs',1)
+            with open_tag_cache(fn_to_mod, args, memo) as cache:
+                deadline = None
+                if getattr(args,'timeout',None):
+                    deadline = cache = DeadlineCache(args.timeout,
+                                                     inner=cache, jobs=jobs)
+                if getattr(args,'asynchronous',False):
+                    metas = run_async(extract_metadata_async(songs, jobs,
+                                            cache, stats,
+                                            getattr(args,'latency',0)), jobs)
+                else:
+                    metas = extract_metadata(songs, jobs=jobs,
+                                   processes=getattr(args,'processes',False),
+                                   cache=cache, stats=stats)
+                if deadline is not None:
+                    metas = list(metas)
+                    if deadline.timed_out:
+                        recovered = deadline.retry(jobs)
+                        metas = [recovered.get(f, meta)
+                                 for f, meta in zip(songs, metas)]
+                        print('{} songs timed out, {} of them were read on '
+                              'retry'.format(len(deadline.timed_out)
+                                             + len(recovered),
+                                             len(recovered)))
+                to_insert = []
+                for f, meta in zip(songs, metas):
+                    f_basename = os.path.basename(f)
+                    to_insert.append((f_basename,
+                                      Entry(os.path.join(fn_prefix,f_basename)
+                                            + '\n', format_EXTINF(*meta))))
+                    inserted_songs.append(f_basename)
+                if stats is not None:
+                    stats.count('songs', len(inserted_songs))
+                    stats.count_cache(cache)
+                    stats.count('bytes_of_playlists_read',
+                                os.path.getsize(fn_to_mod))
+            target = Group() if groups[idx] is None \
+                        else playlist.group(groups[idx])
+            target.insert(to_insert)
             
+            #The playlist is replaced at once, unless only the groups from
+            #the target onward should be rewritten in place
+            changed = {groups[idx]: target}
+            patch = playlist.patch(groups, changed) \
+                        if getattr(args,'in_place',False) else None
+            if patch is None:
+                #The mapped file is still read while the new one is written
+                f = replacing.enter_context(replaced_file(fn_to_mod,
+                                                          binary = True))
+                playlist.write(f, groups, changed)
+        if patch is not None:
+            splice_file(fn_to_mod, *patch)
+        print("{} songs have been inserted into the playlist:"
+                              .format(len(inserted_songs)))
+        for song in inserted_songs:
+            print(song)
+    
+    # Index
+    elif choice == 5:
+        if CONSOLE_MODE:
+            path = args.path[0]
+            index_fn = args.output_fn
+        else:
+            path = input_fn("Please specify the folder of the library\n")
+            index_fn = input_fn("Please specify the index file. It is "
+                                "updated if it exists\n")
+        
+        with LibraryIndex(index_fn) as index:
+            songcount, removed = index.scan(path,
+                                   jobs=getattr(args,'jobs',1),
+                                   processes=getattr(args,'processes',False),
+                                   stats=stats, memo=memo)
+            if stats is not None:
+                stats.count('songs', songcount)
+                stats.count_cache(index)
+        print('{} songs have been indexed, {} read, {} removed'
+              .format(songcount, index.misses, removed))
+    
+    # Query
+    elif choice == 6:
+        query = {}
+        if CONSOLE_MODE:
+            index_fn = args.path[0]
+            output_fn = args.output_fn
+            prefix = args.prefix
+            for name in ['folder', 'artist', 'min_length', 'max_length',
+                         'modified_since']:
+                query[name] = getattr(args, name, None)
+        else:
+            index_fn = input_fn("Please specify the index file\n")
+            output_fn = input_fn("Please specify save filename.\n")
+            prefix = input_fn("Please specify the path prefix to be attached "
+                              "before the filenames\n")
+            print('Leave the following empty to include every song')
+            query['folder'] = input_fn("Folder, relative to the library:\n")
+            query['artist'] = input("Artist, or a part of it:\n")
+            for name in ['min_length', 'max_length']:
+                value = input("{} in seconds:\n"
+                              .format(name.replace('_',' ').capitalize()))
+                query[name] = int(value) if value else None
+            query['modified_since'] = input("Modified since (YYYY-MM-DD):\n")
+        
+        if not os.path.isfile(index_fn):
+            raise SystemExit("Invalid index file specified")
+        if query['modified_since']:
+            from datetime import datetime
+            query['modified_since'] = datetime.fromisoformat(
+                                    query['modified_since']).timestamp()
+        else:
+            query['modified_since'] = None
+        
+        with LibraryIndex(index_fn) as index:
+            songcount, groupcount = index.write_playlist(output_fn, prefix,
+                        os.path.splitext(os.path.basename(output_fn))[0],
+                        **query)
+        if stats is not None:
+            stats.count('songs', songcount)
+        print('{} songs in {} groups have been saved to file'
+                      .format(songcount,groupcount))
+    
+    # Batch
+    elif choice == 7:
+        if CONSOLE_MODE:
+            jobs_fn = args.path[0]
+            workers = getattr(args,'jobs',1)
+        else:
+            jobs_fn = input_fn("Enter the job file. Each line holds the "
+                               "command line parameters of a job\n")
+            workers = int(input("How many jobs should run at the same "
+                                "time?\n") or 1)
+        
+        jobs = read_jobs(jobs_fn)
+        failed = run_batch(jobs, workers)
+        print('{} of {} jobs finished'.format(len(jobs) - failed, len(jobs)))
+        if failed:
+            raise SystemExit('{} jobs failed'.format(failed))
+    
+    # Verify
+    elif choice == 8:
+        if CONSOLE_MODE:
+            fn = args.path[0]
+            path = args.path[1] if len(args.path) > 1 else ''
+            prefix = args.prefix
+            check_lengths = getattr(args,'check_lengths',False)
+            prune = getattr(args,'prune',False)
         else:
-            raise SystemExit("Invalid number specified")
+            fn = input_fn("Enter the playlist to verify:\n")
+            path = input_fn("Please specify the directory the playlist was "
+                            "created from. If none is specified, the "
+                            "playlist's path will be used\n")
+            prefix = input_fn("Please specify the path prefix the playlist "
+                              "was created with\n")
+            check_lengths = input("Check the lengths of the songs? "
+                                  "(y/n)\n").lower() == 'y'
+            prune = input("Remove the missing songs from the playlist? "
+                          "(y/n)\n").lower() == 'y'
+        
+        if not os.path.isfile(fn):
+            raise SystemExit("Invalid playlist specified")
+        if len(path)<1:
+            path = os.path.dirname(fn)
+        
+        with open_tag_cache(fn, args, memo) if check_lengths \
+                else nullcontext() as cache:
+            songcount, missing, stale = verify_playlist(fn, path, prefix,
+                                getattr(args,'jobs',1), check_lengths,
+                                cache, stats)
+            if stats is not None:
+                stats.count('songs', songcount)
+                stats.count('missing', len(missing))
+                stats.count('stale', len(stale))
+                if cache is not None:
+                    stats.count_cache(cache)
+        if prune and (missing or stale):
+            prune_playlist(fn, missing, stale)
+        
+        for _, song in missing:
+            print('Missing: {}'.format(song))
+        for song, meta in stale.values():
+            print('Wrong length: {}, {} seconds'.format(song, meta[0]))
+        print('{} of {} songs are missing, {} have a wrong length'
+              .format(len(missing), songcount, len(stale)))
+        if prune:
+            print('The playlist has been updated')
+    
+    if stats is not None:
+        stats.phases['total'] = time.perf_counter() - start
+        if getattr(args, 'stats', False):
+            print(stats.summary())
+        if getattr(args, 'stats_fn', None):
+            import json
+            with open(args.stats_fn, 'w', encoding='utf-8') as f:
+                json.dump(stats.as_dict(), f, indent=2)
 
 
-if __name__ == '__main__':
+def build_parser():
+    """ The parser of the command line arguments"""
+    import argparse
     parser = argparse.ArgumentParser(description="Welcome to the playlist "
                     "manipulator, command line parameter edition. \nTo use the"
                     "interactive menu, start the command without any "
@@ -516,14 +3683,9 @@ if __name__ == '__main__':
                     "split lists, or insert a new song into it. ",
                     formatter_class=argparse.RawTextHelpFormatter)
     
-    mode_tooltip = "1. Create a playlist from a folder\n"\
-                    "2. Merge several playlists\n"\
-                    "3. Split a playlist, if it has components\n"\
-                    "4. Insert songs from a folder into a playlist\n"
-                
     parser.add_argument('-mode',
                     type = int,
-                    help = mode_tooltip+'\n')
+                    help = MODE_TOOLTIP+'\n')
         
     parser.add_argument('-path',
                         type = str,
@@ -534,17 +3696,24 @@ if __name__ == '__main__':
                         '3: Path to the playlist\n'
                         '4: The song to be inserted or folder containing the '
                         'songs to be inserted. \n'
-                        'It is not parsed recursively\n\n')
+                        'It is not parsed recursively\n'
+                        '5: Folder of the library\n'
+                        '6: The index of the library\n'
+                        '7: The job file. Each line holds the parameters of a '
+                        'job\n'
+                        '8: Path to the playlist, and optionally the folder it '
+                        'was \ncreated from. By default the folder of the '
+                        'playlist\n\n')
 
     parser.add_argument('-output_fn',
                         type = str,
-                        help = 'The file (1,2,4) or folder (3) where the '
-                        'result will be output\n\n')
+                        help = 'The file (1,2,4,6) or folder (3) where the '
+                        'result will be output. \nThe index file for 5\n\n')
         
     parser.add_argument('-prefix',
                         type = str,
                         default = '',
-                        help = 'Applies to modes 1 and 4 only\n'
+                        help = 'Applies to modes 1, 4, 6 and 8 only\n'
                         'A prefix to be applied to the output files. \n'
                         'E.g. if the directory contains song Lala.mp3, '
                         'adding the prefix "Music" \nwill insert the song as '
@@ -564,11 +3733,233 @@ if __name__ == '__main__':
                         "The group in which the seletcted songs will be "
                         "inserted into. \nCounting starts from 0")
     
-    args = parser.parse_args()
+    parser.add_argument('--in_place',
+                         action = 'store_true',
+                         help='Only applies to 4\n'
+                         'If specified, the playlist is only rewritten from '
+                         'the \nmodified group onward, instead of being '
+                         'written to a new \nfile that replaces it. Faster '
+                         'for large playlists, but \nif the program is '
+                         'interrupted or the disk fills up \nmeanwhile, the '
+                         'playlist is left corrupted')
+    
+    parser.add_argument('-sorted',
+                        type = str,
+                        choices = ['playlists', 'groups'],
+                        default = None,
+                        help = 'Applies to mode 2 only\n'
+                        'Merges the songs of the playlists into a single '
+                        'list, \nin natural order of their file names. The '
+                        'songs of each \nplaylist (playlists) or each group '
+                        '(groups) must already \nbe in that order. With '
+                        'groups, the songs of all the groups \nare still '
+                        'merged into one list without groups\n\n')
+    
+    parser.add_argument('-dedup',
+                        type = str,
+                        choices = ['first', 'group'],
+                        default = None,
+                        help = 'Applies to mode 2 only\n'
+                        'Removes the repeated songs, keeping the first one '
+                        'in the \nwhole playlist (first) or in each group '
+                        '(group)\n\n')
+    
+    parser.add_argument('-dedup_key',
+                        type = str,
+                        choices = ['path', 'tags'],
+                        default = 'path',
+                        help = 'Applies to -dedup only\n'
+                        'Songs are the same if their paths are (path), or '
+                        'the \nlength, artist and title of their #EXTINF '
+                        'lines are (tags)\n\n')
+    
+    parser.add_argument('--prune',
+                        action='store_true',
+                        help = 'Applies to mode 8 only\n'
+                        'Removes the missing songs from the playlist, and '
+                        'corrects \nthe wrong lengths\n\n')
+    
+    parser.add_argument('--check_lengths',
+                        action='store_true',
+                        help = 'Applies to mode 8 only\n'
+                        'Reads the songs to check the lengths in their '
+                        '#EXTINF lines. \nThe metadata is cached as in mode 1, '
+                        'see -cache_fn and --no_cache\n\n')
+    
+    parser.add_argument('-jobs',
+                        type=int,
+                        default=1,
+                        help = "Applies to modes 1, 4, 5, 7 and 8 only\n"
+                        "The number of songs whose metadata is read in "
+                        "parallel. \nThe order of the playlist is not "
+                        "affected. \nFor 7, the number of jobs run at the "
+                        "same time. \nFor 8, the number of batches of songs "
+                        "checked at the same time\n\n")
+    
+    parser.add_argument('--processes',
+                         action = 'store_true',
+                         help='Only applies to 1, 4 and 5\n'
+                         'If specified, the -jobs workers are separate '
+                         'processes \ninstead of threads. Useful when tag '
+                         'parsing, not disk access, is the bottleneck')
+    
+    parser.add_argument('--asynchronous',
+                         action = 'store_true',
+                         help='Only applies to 1 and 4\n'
+                         'If specified, folder listings, stats and tag reads '
+                         'are \noverlapped in an asyncio pipeline, -jobs at a '
+                         'time. \nUseful for libraries on network drives. '
+                         'Ignores --processes')
+    
+    parser.add_argument('-latency',
+                         type = float,
+                         default = 0,
+                         help='Only applies to --asynchronous\n'
+                         'Seconds to wait before each folder listing and '
+                         'song read. \nSimulates a network drive, for '
+                         'testing and benchmarking')
+    
+    parser.add_argument('--incremental',
+                         action = 'store_true',
+                         help='Only applies to 1\n'
+                         'If specified and the output file exists, only the '
+                         'songs added or \nmodified since it was written '
+                         'are read')
+    
+    parser.add_argument('-cache_fn',
+                        type = str,
+                        default = None,
+                        help = 'Applies to modes 1, 4 and 8 only\n'
+                        'The file in which the metadata of the songs is cached '
+                        'between runs. \nDefaults to the playlist name with '
+                        'the extension ' + CACHE_EXTENSION + '\n\n')
+    
+    parser.add_argument('-cache_size',
+                        type = int,
+                        default = 1000000,
+                        help = 'Applies to modes 1, 4 and 8 only\n'
+                        'The number of songs kept in the cache. The least '
+                        'recently used ones are removed\n\n')
+    
+    parser.add_argument('--no_cache',
+                         action = 'store_true',
+                         help='Only applies to 1, 4 and 8\n'
+                         'If specified, the metadata of every song is read '
+                         'from the file, \nand no cache is used')
+    
+    parser.add_argument('--rebuild_cache',
+                         action = 'store_true',
+                         help='Only applies to 1, 4 and 8\n'
+                         'If specified, the cache is cleared and the metadata '
+                         'of every \nsong is read again')
+    
+    parser.add_argument('--stats',
+                         action = 'store_true',
+                         help='If specified, the time spent in each phase, '
+                         'the number of songs \nread per second, the cache '
+                         'hit rate and the slowest songs are printed')
+    
+    parser.add_argument('-stats_fn',
+                        type = str,
+                        default = None,
+                        help = 'A JSON file to save the statistics of --stats '
+                        'to\n\n')
+    
+    parser.add_argument('-timeout',
+                        type = float,
+                        default = None,
+                        help = 'Applies to modes 1 and 4 only\n'
+                        'The seconds the metadata of a song may take to '
+                        'read. \nSongs that take longer are saved with '
+                        'their filename, \nand read again at the end with '
+                        'a longer deadline. \nNot applied with '
+                        '--processes\n\n')
+    
+    parser.add_argument('-target',
+                        type = str,
+                        nargs = 2,
+                        action = 'append',
+                        metavar = ('PREFIX', 'OUTPUT_FN'),
+                        help = 'Applies to mode 1 only. Can be repeated\n'
+                        'Also saves the playlist to OUTPUT_FN, with PREFIX '
+                        'instead \nof -prefix. The folder is parsed only '
+                        'once for all of them\n\n')
+    
+    parser.add_argument('--watch',
+                         action = 'store_true',
+                         help='Only applies to 1\n'
+                         'If specified, the folder is watched after the '
+                         'playlist is \ncreated, and the groups of the '
+                         'folders that change are updated, \nuntil Ctrl+C '
+                         'is pressed')
+    
+    parser.add_argument('-interval',
+                        type = float,
+                        default = 2,
+                        help = 'Applies to --watch only\n'
+                        'Seconds between checking the folders for '
+                        'changes\n\n')
+    
+    parser.add_argument('-debounce',
+                        type = float,
+                        default = 1,
+                        help = 'Applies to --watch only\n'
+                        'The playlist is only updated once there were no '
+                        'changes \nfor this many seconds\n\n')
+    
+    parser.add_argument('-folder',
+                        type = str,
+                        default = None,
+                        help = 'Applies to mode 6 only\n'
+                        'Only songs in this folder of the library or its '
+                        'subfolders\n\n')
+    
+    parser.add_argument('-artist',
+                        type = str,
+                        default = None,
+                        help = 'Applies to mode 6 only\n'
+                        'Only songs whose artist contains this text, '
+                        'ignoring case\n\n')
+    
+    parser.add_argument('-min_length',
+                        type = int,
+                        default = None,
+                        help = 'Applies to mode 6 only\n'
+                        'Only songs at least this many seconds long\n\n')
+    
+    parser.add_argument('-max_length',
+                        type = int,
+                        default = None,
+                        help = 'Applies to mode 6 only\n'
+                        'Only songs at most this many seconds long\n\n')
+    
+    parser.add_argument('-modified_since',
+                        type = str,
+                        default = None,
+                        help = 'Applies to mode 6 only\n'
+                        'Only songs modified since this date, e.g. '
+                        '2020-05-10 or \n2020-05-10T11:44\n\n')
+    
+    parser.add_argument('-profile_fn',
+                        type = str,
+                        default = None,
+                        help = 'If specified, the run is profiled with cProfile '
+                        'and the \nresults are saved to this file. They can be '
+                        'viewed with pstats\n\n')
+    
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
     
     CONSOLE_MODE = True if len(argv)>1 else False
     
-    execute_main(CONSOLE_MODE,args)
+    if args.profile_fn is not None:
+        import cProfile
+        cProfile.run('execute_main(CONSOLE_MODE,args)', args.profile_fn)
+    else:
+        execute_main(CONSOLE_MODE,args)
             
         
         
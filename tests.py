@@ -6,10 +6,19 @@ Created on Wed May 13 12:55:46 2020
 """
 
 import os
-from shutil import copy2
+import io
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+from shutil import copy2, copytree, rmtree
 
 import unittest
+import mutagen.id3
 import playlist_manipulator
+import benchmarks
 
 class PlaylistTestCase(unittest.TestCase):
     # Test and gold standard paths
@@ -17,7 +26,12 @@ class PlaylistTestCase(unittest.TestCase):
                      'tests/playlist_create_testcase_2.m3u',
                      'tests/playlist_merge_testcase.m3u',
                     'tests/playlist_insert_testcase1.m3u',
-                    'tests/playlist_insert_testcase2.m3u']
+                    'tests/playlist_insert_testcase2.m3u',
+                    'tests/playlist_create_testcase_parallel.m3u',
+                    'tests/playlist_merge_testcase_invalid.m3u',
+                    'tests/stats_testcase.json',
+                    'tests/library_testcase.idx',
+                    'tests/jobs_testcase.txt']
     
     goldfilenames = ['tests/playlist_create_gold_1.m3u',
                      'tests/playlist_create_gold_2.m3u',
@@ -25,7 +39,7 @@ class PlaylistTestCase(unittest.TestCase):
                      'tests/playlist_insert_gold1.m3u',
                      'tests/playlist_insert_gold2.m3u']
     
-    testfolders = ['tests/split_results']
+    testfolders = ['tests/split_results', 'tests/tag_results']
     
     def test_create(self):
         self.args.mode = 1
@@ -46,6 +60,649 @@ class PlaylistTestCase(unittest.TestCase):
             with self.subTest(i=i):
                 self.assertEqual(f, g)
     
+    def test_create_invalid_path(self):
+        #The playlist is only replaced once the folder was walked
+        self.args.mode = 1
+        self.args.path=[os.path.join('tests','missing')]
+        self.args.prefix = ''
+        self.args.output_fn=self.testfilenames[0]
+        self.args.no_cache = True
+        for asynchronous in [False, True]:
+            with open(self.testfilenames[0],'w',encoding='utf-8') as f:
+                f.write('#EXTM3U\nSong.mp3\n')
+            self.args.asynchronous = asynchronous
+            with self.subTest(asynchronous = asynchronous):
+                with self.assertRaises(OSError):
+                    playlist_manipulator.execute_main(True,self.args)
+                with open(self.testfilenames[0],'r',encoding='utf-8') as f:
+                    self.assertEqual(f.read(), '#EXTM3U\nSong.mp3\n')
+                self.assertFalse(os.path.exists(self.testfilenames[0]
+                                                + '.tmp'))
+    
+    def test_create_parallel(self):
+        self.args.mode = 1
+        self.args.path=[os.path.join('tests','music')]
+        self.args.prefix = ''
+        self.args.no_cache = True
+        
+        #The serial result is the reference, since the order of the files in
+        #the folder depends on the file system
+        self.args.output_fn=self.testfilenames[0]
+        playlist_manipulator.execute_main(True,self.args)
+        f = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        
+        self.args.output_fn=self.testfilenames[5]
+        for i,processes in enumerate([False,True]):
+            self.args.jobs = 3
+            self.args.processes = processes
+            playlist_manipulator.execute_main(True,self.args)
+            g = open(self.testfilenames[5],'r',encoding='utf-8').readlines()
+            
+            with self.subTest(i=i):
+                #Only the name of the top group differs
+                self.assertEqual(f[2:], g[2:])
+    
+    def test_create_async(self):
+        self.args.mode = 1
+        self.args.path=[os.path.join('tests','music')]
+        self.args.prefix = ''
+        self.args.no_cache = True
+        
+        self.args.output_fn=self.testfilenames[0]
+        playlist_manipulator.execute_main(True,self.args)
+        f = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        
+        #The songs are read at the same time, up to -jobs of them, and are
+        #still written in order
+        reading = [0, 0]
+        lock = threading.Lock()
+        get_metadata = playlist_manipulator.get_metadata
+        def counted(filename):
+            with lock:
+                reading[0] += 1
+                reading[1] = max(reading)
+            try:
+                time.sleep(0.05)
+                return get_metadata(filename)
+            finally:
+                with lock:
+                    reading[0] -= 1
+        playlist_manipulator.get_metadata = counted
+        self.args.output_fn=self.testfilenames[5]
+        self.args.asynchronous = True
+        self.args.jobs = 4
+        try:
+            playlist_manipulator.execute_main(True,self.args)
+        finally:
+            playlist_manipulator.get_metadata = get_metadata
+        g = open(self.testfilenames[5],'r',encoding='utf-8').readlines()
+        self.assertEqual(f[2:], g[2:])
+        self.assertGreater(reading[1], 1)
+        self.assertLessEqual(reading[1], self.args.jobs)
+    
+    def test_watch(self):
+        library = os.path.join('tests','watch_results')
+        copytree(os.path.join('tests','music'), library)
+        self.addCleanup(rmtree, library)
+        self.args.mode = 1
+        self.args.path=[library]
+        self.args.prefix = ''
+        self.args.no_cache = True
+        self.args.output_fn=self.testfilenames[0]
+        
+        watcher = playlist_manipulator.PlaylistWatcher(library, '',
+                                                       self.testfilenames[5])
+        self.assertEqual(watcher.build(), 8)
+        self.assertEqual(watcher.poll(), 0)
+        
+        #A song is added, a folder is added and a folder is removed
+        album = os.path.join(library,'Artist1','Album1')
+        song = os.path.join(album, os.listdir(album)[0])
+        copy2(song, os.path.join(album,'Song9.mp3'))
+        os.makedirs(os.path.join(library,'New'))
+        copy2(song, os.path.join(library,'New','Song10.mp3'))
+        rmtree(os.path.join(library,'Artist1','Album2'))
+        
+        self.assertGreater(watcher.poll(), 0)
+        #Nothing is updated until the changes settle
+        self.assertEqual(watcher.update(debounce=60), (0, 0))
+        folders, songs = watcher.update()
+        self.assertEqual(songs, 2)
+        
+        #Without a group title, the songs of the folder are not in a group
+        playlist_manipulator.save_tracklist_to_file(
+                playlist_manipulator.iter_all_files(library), library, '',
+                self.testfilenames[1])
+        f = open(self.testfilenames[1],'r',encoding='utf-8').readlines()
+        g = open(self.testfilenames[5],'r',encoding='utf-8').readlines()
+        self.assertEqual(f, g)
+        
+        #With the title mode 1 uses, the playlists are the same
+        watcher = playlist_manipulator.PlaylistWatcher(library, '',
+                        self.testfilenames[5], 'playlist_create_testcase_1')
+        watcher.build()
+        playlist_manipulator.execute_main(True,self.args)
+        f = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        g = open(self.testfilenames[5],'r',encoding='utf-8').readlines()
+        self.assertEqual(f, g)
+    
+    def test_create_cache(self):
+        self.args.mode = 1
+        self.args.path=[os.path.join('tests','music')]
+        self.args.prefix = ''
+        self.args.output_fn=self.testfilenames[0]
+        cache_fn = playlist_manipulator.default_cache_fn(self.testfilenames[0])
+        
+        playlist_manipulator.execute_main(True,self.args)
+        f = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        
+        #A title that is only in the cache shows that the song was not read
+        song = os.path.join('tests','music','Artist1','Song5.mp3')
+        with playlist_manipulator.TagCache(cache_fn) as cache:
+            signature = playlist_manipulator.file_signature(song)
+            self.assertEqual(cache.lookup(song, signature), (0,'','Song5'))
+            cache.store(song, signature, (0,'','Cached'))
+        
+        playlist_manipulator.execute_main(True,self.args)
+        g = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        self.assertIn('#EXTINF:0,Cached\n', g)
+        
+        self.args.rebuild_cache = True
+        playlist_manipulator.execute_main(True,self.args)
+        g = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        self.assertEqual(f, g)
+        
+        #The songs are committed while the cache is open, every few stores
+        #and after every update of the watcher
+        import sqlite3
+        def committed():
+            db = sqlite3.connect(cache_fn)
+            try:
+                return db.execute('SELECT COUNT(*) FROM tags').fetchone()[0]
+            finally:
+                db.close()
+        self.addCleanup(setattr, playlist_manipulator, 'CACHE_COMMIT_INTERVAL',
+                        playlist_manipulator.CACHE_COMMIT_INTERVAL)
+        playlist_manipulator.CACHE_COMMIT_INTERVAL = 2
+        with playlist_manipulator.TagCache(cache_fn, rebuild = True) as cache:
+            for name in ['Song5.mp3', 'Song6.mp3',
+                         os.path.join('Album1','Song1.mp3')]:
+                song = os.path.join('tests','music','Artist1',name)
+                cache.store(song, playlist_manipulator.file_signature(song),
+                            (0, '', name))
+            self.assertEqual(committed(), 2)
+        playlist_manipulator.CACHE_COMMIT_INTERVAL = 1000
+        with playlist_manipulator.TagCache(cache_fn, rebuild = True) as cache:
+            watcher = playlist_manipulator.PlaylistWatcher(
+                    self.args.path[0], '', self.testfilenames[5],
+                    cache = playlist_manipulator.DeadlineCache(10, cache))
+            watcher.build()
+            self.assertEqual(committed(), 8)
+    
+    def test_cache_moved(self):
+        folder = self.testfolders[1]
+        os.makedirs(folder)
+        cache_fn = playlist_manipulator.default_cache_fn(self.testfilenames[0])
+        tagged = os.path.join(folder, 'Tagged.mp3')
+        untagged = os.path.join(folder, 'Untagged.mp3')
+        benchmarks.write_mp3(tagged, 'Artist', 'Title')
+        with open(untagged, 'wb') as f:
+            f.write((benchmarks.MP3_FRAME_HEADER + bytes(413)) * 40)
+        #Tagged with an artist only, so its title is its filename
+        untitled = os.path.join(folder, 'Untitled.mp3')
+        with open(untitled, 'wb') as f:
+            f.write((benchmarks.MP3_FRAME_HEADER + bytes(413)) * 41)
+        tags = mutagen.id3.ID3()
+        tags.add(mutagen.id3.TPE1(encoding=3, text=['Artist']))
+        tags.save(untitled)
+        
+        #A cache written before the fingerprints were added is upgraded
+        import sqlite3
+        db = sqlite3.connect(cache_fn)
+        db.execute('CREATE TABLE tags (path TEXT PRIMARY KEY, size INTEGER, '
+                   'mtime INTEGER, inode INTEGER, length INTEGER, '
+                   'artist TEXT, title TEXT, used INTEGER)')
+        db.commit()
+        db.close()
+        with playlist_manipulator.TagCache(cache_fn) as cache:
+            for fn in [tagged, untagged, untitled]:
+                cache.get_metadata(fn)
+        
+        reads = []
+        def read(fn):
+            reads.append(fn)
+            return playlist_manipulator.get_metadata(fn)
+        os.rename(tagged, os.path.join(folder, 'Moved.mp3'))
+        os.rename(untagged, os.path.join(folder, 'Renamed.mp3'))
+        os.rename(untitled, os.path.join(folder, 'Retitled.mp3'))
+        with playlist_manipulator.TagCache(cache_fn) as cache:
+            self.assertEqual(cache.get_metadata(os.path.join(folder,
+                                                'Moved.mp3'), read),
+                             (1, 'Artist', 'Title'))
+            #The title of a song without tags is its filename
+            self.assertEqual(cache.get_metadata(os.path.join(folder,
+                                                'Renamed.mp3'), read),
+                             (1, '', 'Renamed'))
+            self.assertEqual(cache.get_metadata(os.path.join(folder,
+                                                'Retitled.mp3'), read),
+                             (1, 'Artist', 'Retitled'))
+            self.assertEqual((cache.hits, cache.moved, cache.misses),
+                             (1, 1, 2))
+        self.assertEqual(reads, [os.path.join(folder, 'Renamed.mp3'),
+                                 os.path.join(folder, 'Retitled.mp3')])
+        
+        #On a cold build in processes, the fingerprints are computed by the
+        #processes reading the songs, not by the lookups
+        fingerprints = []
+        file_fingerprint = playlist_manipulator.file_fingerprint
+        def fingerprint(filename, *args):
+            fingerprints.append(filename)
+            return file_fingerprint(filename, *args)
+        playlist_manipulator.file_fingerprint = fingerprint
+        self.args.mode = 1
+        self.args.path = [folder]
+        self.args.prefix = ''
+        self.args.output_fn = self.testfilenames[0]
+        self.args.rebuild_cache = True
+        self.args.jobs = 2
+        self.args.processes = True
+        try:
+            playlist_manipulator.execute_main(True,self.args)
+        finally:
+            playlist_manipulator.file_fingerprint = file_fingerprint
+        self.assertEqual(fingerprints, [])
+        db = sqlite3.connect(cache_fn)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM tags WHERE '
+                                    'fingerprint IS NOT NULL').fetchone()[0],
+                         3)
+        db.close()
+    
+    def test_create_incremental(self):
+        self.args.mode = 1
+        self.args.path=[os.path.join('tests','music')]
+        self.args.prefix = ''
+        self.args.output_fn=self.testfilenames[0]
+        self.args.no_cache = True
+        
+        playlist_manipulator.execute_main(True,self.args)
+        f = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        
+        #Unchanged songs keep the #EXTINF line of the previous version
+        stale = [line.replace('Song5','Stale') if line[:8]=='#EXTINF:'
+                 else line for line in f]
+        open(self.testfilenames[0],'w',encoding='utf-8').writelines(stale)
+        self.args.incremental = True
+        playlist_manipulator.execute_main(True,self.args)
+        g = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        self.assertEqual(stale, g)
+        
+        #Songs modified since the playlist was written are read again
+        os.utime(self.testfilenames[0], (0, 0))
+        playlist_manipulator.execute_main(True,self.args)
+        g = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        self.assertEqual(f, g)
+    
+    def test_create_stats(self):
+        self.args.mode = 1
+        self.args.path=[os.path.join('tests','music')]
+        self.args.prefix = ''
+        self.args.output_fn=self.testfilenames[0]
+        self.args.stats_fn=self.testfilenames[7]
+        
+        playlist_manipulator.execute_main(True,self.args)
+        stats = json.load(open(self.testfilenames[7],'r',encoding='utf-8'))
+        
+        self.assertEqual(stats['counters']['songs'], 8)
+        self.assertEqual(stats['counters']['songs_read'], 8)
+        self.assertEqual(stats['counters']['cache_misses'], 8)
+        self.assertEqual(len(stats['slowest']), 8)
+        self.assertTrue(all(phase in stats['phases'] for phase in
+                            ['walk', 'metadata', 'write', 'total']))
+    
+    def test_create_timeout(self):
+        self.args.mode = 1
+        self.args.path=[os.path.join('tests','music')]
+        self.args.prefix = ''
+        self.args.output_fn=self.testfilenames[0]
+        self.args.no_cache = True
+        playlist_manipulator.execute_main(True,self.args)
+        f = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        
+        #The first read of a song stalls
+        stalled = []
+        get_metadata = playlist_manipulator.get_metadata
+        def read(filename):
+            if 'Song5' in filename and not stalled:
+                stalled.append(filename)
+                time.sleep(1)
+            return get_metadata(filename)
+        playlist_manipulator.get_metadata = read
+        self.args.timeout = 0.2
+        self.args.jobs = 2
+        self.args.stats_fn = self.testfilenames[7]
+        try:
+            playlist_manipulator.execute_main(True,self.args)
+        finally:
+            playlist_manipulator.get_metadata = get_metadata
+        g = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        self.assertEqual(f, g)
+        stats = json.load(open(self.testfilenames[7],'r',encoding='utf-8'))
+        self.assertEqual(stats['counters']['timeouts'], 1)
+        self.assertEqual(stats['counters']['timeouts_recovered'], 1)
+        
+        #The watcher reads the songs that timed out again as well
+        stalled = []
+        def read(filename):
+            if 'Song5' in filename:
+                if not stalled:
+                    stalled.append(filename)
+                    time.sleep(1)
+                return 7, 'Artist', 'Title'
+            return get_metadata(filename)
+        playlist_manipulator.get_metadata = read
+        try:
+            watcher = playlist_manipulator.PlaylistWatcher(
+                    self.args.path[0], '', self.testfilenames[5],
+                    cache = playlist_manipulator.DeadlineCache(0.2, jobs = 2))
+            watcher.build()
+        finally:
+            playlist_manipulator.get_metadata = get_metadata
+        g = open(self.testfilenames[5],'r',encoding='utf-8').readlines()
+        self.assertIn('#EXTINF:7,Artist – Title\n', g)
+        
+        #The lookup in the inner cache is under the deadline too, and the
+        #threads are reused
+        class Stalled(playlist_manipulator.MetadataCache):
+            def get_metadata(self, filename, read = None):
+                time.sleep(0.5)
+                return read(filename)
+        song = os.path.join('tests','music','Artist1','Song6.mp3')
+        deadline = playlist_manipulator.DeadlineCache(0.05, Stalled())
+        self.assertEqual(deadline.get_metadata(song), (0, '', 'Song6'))
+        deadline = playlist_manipulator.DeadlineCache(1)
+        for _ in range(20):
+            deadline.get_metadata(song)
+        self.assertEqual(deadline._executor._workers, 1)
+        
+        #Songs that hang for good do not hold up the others
+        hung = threading.Event()
+        self.addCleanup(hung.set)
+        def hang(filename):
+            if filename.startswith('hang'):
+                hung.wait()
+            return 1, 'Artist', filename
+        deadline = playlist_manipulator.DeadlineCache(0.2)
+        self.assertEqual([deadline.get_metadata(fn, hang)[2] for fn in
+                          ['hang1', 'hang2', 'a', 'b', 'c', 'd']],
+                         ['hang1', 'hang2', 'a', 'b', 'c', 'd'])
+        self.assertEqual(deadline.timed_out, ['hang1', 'hang2'])
+        self.assertEqual(deadline.retry(read = hang, factor = 1), {})
+        self.assertEqual(deadline.get_metadata('e', hang), (1, 'Artist', 'e'))
+        self.assertLessEqual(deadline._executor._workers, 2)
+        
+        #Songs that time out again keep the lines without tags
+        song = os.path.join('tests','music','Artist1','Song5.mp3')
+        deadline = playlist_manipulator.DeadlineCache(0.05)
+        slow = lambda filename: time.sleep(0.5) or (1, 'Artist', 'Title')
+        self.assertEqual(deadline.get_metadata(song, slow), (0, '', 'Song5'))
+        self.assertEqual(deadline.retry(read = slow, factor = 2), {})
+        self.assertEqual(deadline.timed_out, [song])
+        recovered = deadline.retry(read = slow, factor = 20)
+        self.assertEqual(recovered, {song: (1, 'Artist', 'Title')})
+        self.assertEqual((deadline.timed_out, deadline.recovered), ([], 1))
+        
+        self.assertEqual(playlist_manipulator.refresh_playlist_metadata(
+                self.testfilenames[0], os.path.join('tests','music'), '',
+                recovered), 1)
+        g = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        i = f.index(os.path.join('Artist1','Song5.mp3') + '\n')
+        self.assertEqual(g, f[:i-1] + ['#EXTINF:1,Artist – Title\n']
+                         + f[i:])
+    
+    def test_index(self):
+        self.args.mode = 5
+        self.args.path=[os.path.join('tests','music')]
+        self.args.output_fn=self.testfilenames[8]
+        playlist_manipulator.execute_main(True,self.args)
+        
+        #Without conditions the playlist is the same as the created one
+        self.args.mode = 6
+        self.args.path=[self.testfilenames[8]]
+        self.args.output_fn=self.testfilenames[5]
+        self.args.prefix = ''
+        playlist_manipulator.execute_main(True,self.args)
+        g = open(self.testfilenames[5],'r',encoding='utf-8').readlines()
+        
+        self.args.mode = 1
+        self.args.path=[os.path.join('tests','music')]
+        self.args.output_fn=self.testfilenames[0]
+        self.args.no_cache = True
+        playlist_manipulator.execute_main(True,self.args)
+        f = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        self.assertEqual(f[2:], g[2:])
+        
+        with playlist_manipulator.LibraryIndex(self.testfilenames[8]) as index:
+            folder = os.path.join('Artist1','Album1')
+            paths = [row[0] for row in index.query(folder=folder)]
+            self.assertEqual(sorted(paths),
+                             sorted(os.path.join(folder, fn) for fn in
+                                    os.listdir(os.path.join('tests','music',
+                                                            folder))))
+            self.assertEqual(list(index.query(min_length=1)), [])
+            self.assertEqual(list(index.query(artist='%')), [])
+    
+    def test_create_targets(self):
+        music = os.path.join('tests','music')
+        targets = [('Music', self.testfilenames[0]),
+                   (os.path.join('mnt','nas'), self.testfilenames[1]),
+                   ('', self.testfilenames[5])]
+        expected = []
+        for prefix, fn in targets:
+            args = type('', (), {'mode': 1, 'path': [music], 'prefix': prefix,
+                                 'output_fn': fn, 'no_cache': True})()
+            playlist_manipulator.execute_main(True,args)
+            with open(fn,'r',encoding='utf-8') as f:
+                expected.append(f.read())
+            os.remove(fn)
+        
+        self.args.mode = 1
+        self.args.path = [music]
+        self.args.prefix, self.args.output_fn = targets[0]
+        self.args.target = [list(target) for target in targets[1:]]
+        self.args.no_cache = True
+        playlist_manipulator.execute_main(True,self.args)
+        for (prefix, fn), text in zip(targets, expected):
+            with self.subTest(prefix = prefix):
+                with open(fn,'r',encoding='utf-8') as f:
+                    self.assertEqual(f.read(), text)
+        
+        #Writes more songs than a batch, with a reader of every song
+        reads = []
+        class Cache(playlist_manipulator.MetadataCache):
+            def get_metadata(self, filename, read = None):
+                reads.append(filename)
+                return 0, '', filename
+        tracks = ['?#EXTGRP:Folder'] + ['{}.mp3'.format(i) for i in range(600)]
+        counts = playlist_manipulator.save_tracklist_to_files(
+                tracks, music, [(p, fn, '') for p, fn in targets[:2]],
+                jobs = 2, cache = Cache())
+        self.assertEqual(counts, [(600, 1), (600, 1)])
+        self.assertEqual(len(reads), 600)
+    
+    def test_verify(self):
+        music = os.path.join('tests','music')
+        self.args.mode = 1
+        self.args.path = [music]
+        self.args.prefix = ''
+        self.args.output_fn = self.testfilenames[0]
+        self.args.no_cache = True
+        playlist_manipulator.execute_main(True,self.args)
+        with open(self.testfilenames[0],'r',encoding='utf-8') as f:
+            created = f.read()
+        with open(self.testfilenames[0],'a',encoding='utf-8') as f:
+            f.write('#EXTGRP:Broken\n#EXTINF:0,Gone\nGone.mp3\n'
+                    '#EXTINF:999,Song5\n{0}\n#EXTINF:-1,Song5\n{0}\n'
+                    .format(os.path.join('Artist1','Song5.mp3')))
+        
+        fn = self.testfilenames[0]
+        song = os.path.join('Artist1','Song5.mp3')
+        for jobs in [1, 3]:
+            with self.subTest(jobs = jobs):
+                songcount, missing, stale = \
+                    playlist_manipulator.verify_playlist(
+                        fn, music, '', jobs, check_lengths = True,
+                        batch_size = 2)
+                self.assertEqual(songcount, 11)
+                self.assertEqual(missing, [(8, 'Gone.mp3')])
+                #The unknown length -1 is not stale
+                self.assertEqual(list(stale), [9])
+                self.assertEqual(stale[9][0], song)
+        
+        #The lengths are read without a cache, unless one is asked for
+        cache_fn = playlist_manipulator.default_cache_fn(fn)
+        self.args.mode = 8
+        self.args.path = [fn, music]
+        self.args.check_lengths = True
+        self.args.prune = False
+        playlist_manipulator.execute_main(True,self.args)
+        self.assertFalse(os.path.exists(cache_fn))
+        self.args.no_cache = False
+        self.args.cache_fn = self.testfilenames[8]
+        playlist_manipulator.execute_main(True,self.args)
+        self.assertFalse(os.path.exists(cache_fn))
+        self.assertTrue(os.path.exists(self.testfilenames[8]))
+        
+        self.args.no_cache = True
+        self.args.prune = True
+        playlist_manipulator.execute_main(True,self.args)
+        with open(fn,'r',encoding='utf-8') as f:
+            self.assertEqual(f.read(), created + '#EXTGRP:Broken\n'
+                             '#EXTINF:0,Song5\n{0}\n#EXTINF:-1,Song5\n{0}\n'
+                             .format(song))
+        songcount, missing, stale = playlist_manipulator.verify_playlist(
+                fn, music, '', check_lengths = True)
+        self.assertEqual((songcount, missing, stale), (10, [], {}))
+        
+        #A failed prune leaves the playlist as it was
+        with open(fn,'r',encoding='utf-8') as f:
+            pruned = f.read()
+        with self.assertRaises(TypeError):
+            playlist_manipulator.prune_playlist(fn, [(0, 'a.mp3')],
+                                                {1: ('b.mp3', None)})
+        with open(fn,'r',encoding='utf-8') as f:
+            self.assertEqual(f.read(), pruned)
+        self.assertFalse(os.path.exists(fn + '.tmp'))
+    
+    def test_batch(self):
+        music = os.path.join('tests','music')
+        jobs = ['-mode 1 -path "{}" -output_fn "{}" --no_cache'
+                    .format(music, self.testfilenames[0]),
+                '# Overlaps with the first one',
+                '-mode 1 -path "{}" -output_fn "{}" --no_cache -jobs 2'
+                    .format(os.path.join(music,'Artist1'),
+                            self.testfilenames[1]),
+                '',
+                '-mode 2 -path "{}" "{}" -output_fn "{}"'
+                    .format(self.testfilenames[0], self.testfilenames[1],
+                            self.testfilenames[2])]
+        open(self.testfilenames[9],'w',encoding='utf-8')\
+            .write('\n'.join(jobs))
+        
+        reads = []
+        get_metadata = playlist_manipulator.get_metadata
+        def counted(filename):
+            reads.append(filename)
+            return get_metadata(filename)
+        playlist_manipulator.get_metadata = counted
+        try:
+            self.args.mode = 7
+            self.args.path = [self.testfilenames[9]]
+            self.args.jobs = 3
+            playlist_manipulator.execute_main(True,self.args)
+        finally:
+            playlist_manipulator.get_metadata = get_metadata
+        #Every song is read once
+        self.assertEqual(len(reads), 8)
+        self.assertEqual(len(set(reads)), 8)
+        
+        #The merge waited for both playlists
+        f = open(self.testfilenames[0],'r',encoding='utf-8').readlines()
+        g = open(self.testfilenames[1],'r',encoding='utf-8').readlines()
+        h = open(self.testfilenames[2],'r',encoding='utf-8').readlines()
+        self.assertEqual(h, f + g[1:])
+
+        #The merge waits for the playlists written into the folder of the
+        #split
+        split = self.testfolders[0]
+        os.mkdir(split)
+        open(self.testfilenames[9],'w',encoding='utf-8').write(
+            '-mode 3 -path "{0}" -output_fn "{1}" --overwrite\n'
+            '-mode 2 -path "{2}" "{3}" -output_fn "{4}"'
+            .format(self.testfilenames[0], split,
+                    os.path.join(split, 'Album1.m3u'),
+                    os.path.join(split, 'Album2.m3u'),
+                    self.testfilenames[2]))
+        playlist_manipulator.execute_main(True,self.args)
+        h = open(self.testfilenames[2],'r',encoding='utf-8').readlines()
+        self.assertEqual([line for line in h if line[0] != '#'],
+                         [os.path.join('Artist1', album, name) + '\n'
+                          for album, name in [('Album1', 'Song1.mp3'),
+                                              ('Album1', 'Song2.mp3'),
+                                              ('Album2', 'Song 3.mp3'),
+                                              ('Album2', 'Song 4.mp3')]])
+
+        #Jobs sharing a tag cache do not run at the same time
+        jobs = [playlist_manipulator.build_parser().parse_args(
+                    ['-mode', '1', '-path', music, '-output_fn', fn]
+                    + options)
+                for fn, options in [('a.m3u', ['-cache_fn', 'tags.db']),
+                                    ('b.m3u', ['-cache_fn', 'tags.db']),
+                                    ('c.m3u', []),
+                                    ('d.m3u', ['-cache_fn', 'tags.db',
+                                               '--no_cache'])]]
+        files = [playlist_manipulator._job_files(args) for args in jobs]
+        self.assertEqual([playlist_manipulator._overlap(files[0][1], used)
+                          for used, _ in files[1:]], [True, False, False])
+        
+        #A pruned playlist is written by the verification
+        parse = playlist_manipulator.build_parser().parse_args
+        jobs = [parse(['-mode', '8', '-path', 'x.m3u', '--prune']),
+                parse(['-mode', '8', '-path', 'x.m3u', '--prune']),
+                parse(['-mode', '2', '-path', 'x.m3u', 'y.m3u',
+                       '-output_fn', 'z.m3u']),
+                parse(['-mode', '8', '-path', 'x.m3u'])]
+        files = [playlist_manipulator._job_files(args) for args in jobs]
+        self.assertEqual([playlist_manipulator._overlap(files[0][1], used)
+                          for used, _ in files[1:]], [True, True, True])
+        self.assertEqual(files[3][1], set())
+
+        #A failed job fails the dependent ones, but not the others
+        open(self.testfilenames[9],'w',encoding='utf-8').write(
+            '-mode 3 -path missing.m3u -output_fn "{}"\n'
+            '-mode 2 -path "{}" -output_fn missing.m3u\n'
+            '-mode 1 -path "{}" -output_fn "{}" --no_cache'
+            .format(self.testfolders[0], self.testfilenames[0], music,
+                    self.testfilenames[3]))
+        with self.assertRaises(SystemExit):
+            playlist_manipulator.execute_main(True,self.args)
+        self.assertFalse(os.path.exists('missing.m3u'))
+        self.assertTrue(os.path.exists(self.testfilenames[3]))
+    
+    def test_lazy_imports(self):
+        #Merging and splitting do not need the modules of the other modes
+        script = ('import sys, playlist_manipulator as pm\n'
+                  'args = type("", (), {{}})()\n'
+                  'args.mode = 2\n'
+                  'args.path = ["{0}", "{0}"]\n'
+                  'args.output_fn = "{1}"\n'
+                  'pm.execute_main(True, args)\n'
+                  'print(sorted(m for m in ["mutagen", "asyncio", "sqlite3",'
+                  ' "argparse", "concurrent.futures"] if m in sys.modules))'
+                  .format(self.goldfilenames[0], self.testfilenames[2]))
+        result = subprocess.run([sys.executable, '-c', script],
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.splitlines()[-1], '[]')
+    
     def test_merge(self):
         self.args.mode = 2
         self.args.path = [self.goldfilenames[i] for i in [0,1,0]]
@@ -58,6 +715,119 @@ class PlaylistTestCase(unittest.TestCase):
                     .readlines()
         self.assertEqual(f,g)
     
+    def test_merge_invalid(self):
+        self.args.mode = 2
+        self.args.output_fn = self.testfilenames[2]
+        invalid = self.testfilenames[6]
+        with open(invalid,'wb') as f:
+            f.write('#EXTM3U\n#EXTINF:0,Song\nSong.mp3\n'.encode('utf-8'))
+            f.write(b'\xff\xfe\n')
+        
+        #Unreadable files are left out entirely
+        self.args.path = [self.goldfilenames[0], invalid, 'tests/missing.m3u',
+                          self.goldfilenames[1], self.goldfilenames[0]]
+        f = open(self.goldfilenames[2],'r',encoding='utf-8')\
+            .readlines()
+        playlist_manipulator.execute_main(True,self.args)
+        g = open(self.testfilenames[2],'r',encoding='utf-8')\
+                    .readlines()
+        self.assertEqual(f,g)
+        
+        #The sorted merge leaves them out as well
+        playlist_manipulator.merge_sorted_playlists(
+                [self.goldfilenames[i] for i in [0,1,0]], self.testfilenames[2])
+        f = open(self.testfilenames[2],'r',encoding='utf-8').readlines()
+        self.args.sorted = 'playlists'
+        playlist_manipulator.execute_main(True,self.args)
+        g = open(self.testfilenames[2],'r',encoding='utf-8').readlines()
+        self.assertEqual(f,g)
+    
+    def test_merge_dedup(self):
+        self.args.mode = 2
+        self.args.output_fn = self.testfilenames[2]
+        a, b = self.testfilenames[6], self.testfilenames[7]
+        with open(a,'w',encoding='utf-8') as f:
+            f.write('#EXTM3U\n#EXTINF:10,A – One\nMusic\\One.mp3\n'
+                    '#EXTGRP:Rock\n#EXTINF:20,B – Two\nMusic\\Two.mp3\n'
+                    'Music/./One.mp3\n')
+        with open(b,'w',encoding='utf-8') as f:
+            f.write('#EXTM3U\n#EXTGRP:Rock\n#EXTINF:20,B – Two\n'
+                    'Music/Two.mp3\n#EXTINF:30,C – Three\nThree.mp3\n'
+                    '#EXTGRP:Pop\n#EXTINF:10,a – one\nOther/One.mp3\n')
+        self.args.path = [a, b]
+        
+        expected = {('first','path'): ['#EXTINF:30,C – Three','Three.mp3',
+                                       '#EXTINF:10,a – one','Other/One.mp3'],
+                    ('first','tags'): ['Music/./One.mp3',
+                                       '#EXTINF:30,C – Three','Three.mp3'],
+                    ('group','path'): ['Music/./One.mp3',
+                                       '#EXTINF:30,C – Three','Three.mp3',
+                                       '#EXTINF:10,a – one','Other/One.mp3']}
+        for (policy, key), kept in expected.items():
+            with self.subTest(policy = policy, key = key):
+                self.args.dedup = policy
+                self.args.dedup_key = key
+                playlist_manipulator.execute_main(True,self.args)
+                with open(self.testfilenames[2],'r',encoding='utf-8') as f:
+                    lines = f.read().splitlines()
+                self.assertEqual(lines[:5], ['#EXTM3U','#EXTINF:10,A – One',
+                                             'Music\\One.mp3','#EXTGRP:Rock',
+                                             '#EXTINF:20,B – Two'])
+                self.assertEqual([line for line in lines[6:]
+                                  if line[:8] != '#EXTGRP:'], kept)
+    
+    def test_merge_sorted(self):
+        rng = random.Random(0)
+        fns = [self.testfilenames[i] for i in [0, 1, 5]]
+        songs = []
+        for k, fn in enumerate(fns):
+            groups = []
+            for g in range(3):
+                names = sorted(('Song {}.mp3'.format(rng.randint(1, 30))
+                                for _ in range(rng.randint(0, 6))),
+                               key = playlist_manipulator.natural_key)
+                groups.append([('#EXTINF:{},{}\n'.format(k, name[:-4]),
+                                'Folder{}\\{}\n'.format(g, name))
+                               for name in names])
+            songs.append(groups)
+            with open(fn,'w',encoding='utf-8',newline='') as f:
+                f.write('#EXTM3U\r\n')
+                for g, group in enumerate(groups):
+                    f.write('#EXTGRP:Group {}\r\n'.format(g))
+                    for info, path in group:
+                        f.write(info.replace('\n','\r\n') + path[:-1])
+                        f.write('\r\n' if info[8] == '0' else '\n')
+        
+        def expected(runs):
+            songs = sorted((song for run in runs for song in run),
+                           key = lambda song: playlist_manipulator
+                           .natural_key(song[1][8:-1]))
+            return ['#EXTM3U\n'] + [line for song in songs for line in song]
+        
+        self.args.mode = 2
+        self.args.path = fns
+        self.args.output_fn = self.testfilenames[2]
+        self.args.sorted = 'groups'
+        playlist_manipulator.execute_main(True,self.args)
+        with open(self.testfilenames[2],'r',encoding='utf-8') as f:
+            self.assertEqual(f.readlines(), expected(group for groups in songs
+                                                     for group in groups))
+        
+        #Each group is sorted, but the playlists are not
+        songcount, disorder = playlist_manipulator.merge_sorted_playlists(
+                fns, self.testfilenames[2])
+        self.assertEqual(songcount, sum(len(group) for groups in songs
+                                        for group in groups))
+        self.assertGreater(disorder, 0)
+        
+        self.args.path = [fns[0], fns[0]]
+        self.args.dedup = 'first'
+        playlist_manipulator.execute_main(True,self.args)
+        with open(self.testfilenames[2],'r',encoding='utf-8') as f:
+            lines = f.readlines()
+        unique = dict.fromkeys(song for group in songs[0] for song in group)
+        self.assertEqual(lines, expected([unique]))
+    
     def tests_split(self):
         self.args.mode = 3
         self.args.path = [self.goldfilenames[0]]
@@ -110,6 +880,236 @@ class PlaylistTestCase(unittest.TestCase):
         self.assertEqual(f,g)
         
         
+    def test_insert_in_place(self):
+        #Rewriting the playlist in place gives the same file as replacing it
+        self.args.mode = 4
+        self.args.path = [os.path.join('tests','music','Artist1')]
+        self.args.prefix = 'Artist1'
+        self.args.target_group = 1
+        results = []
+        for i, in_place in enumerate([False, True]):
+            copy2(self.goldfilenames[0],self.testfilenames[3+i])
+            self.args.output_fn = self.testfilenames[3+i]
+            self.args.in_place = in_place
+            playlist_manipulator.execute_main(True,self.args)
+            with open(self.testfilenames[3+i],'rb') as f:
+                results.append(f.read())
+            self.assertFalse(os.path.exists(self.testfilenames[3+i] + '.tmp'))
+        self.assertEqual(results[0], results[1])
+        with open(self.goldfilenames[0],'rb') as f:
+            self.assertNotEqual(results[0], f.read())
+        
+        #A failed write leaves the playlist as it was, without the new file
+        copy2(self.goldfilenames[0],self.testfilenames[3])
+        self.args.output_fn = self.testfilenames[3]
+        self.args.in_place = False
+        write = playlist_manipulator.MappedPlaylist.write
+        def failing(self, f, *args):
+            f.write(b'partial')
+            raise OSError('disk full')
+        playlist_manipulator.MappedPlaylist.write = failing
+        try:
+            with self.assertRaises(OSError):
+                playlist_manipulator.execute_main(True,self.args)
+        finally:
+            playlist_manipulator.MappedPlaylist.write = write
+        with open(self.testfilenames[3],'rb') as f, \
+                open(self.goldfilenames[0],'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertFalse(os.path.exists(self.testfilenames[3] + '.tmp'))
+    
+    def test_read_header_metadata(self):
+        #The fast path must agree with mutagen, or leave the file to it
+        folder = self.testfolders[1]
+        os.makedirs(folder)
+        songs = []
+        for i, (artist, title) in enumerate([('Artist', 'Song'),
+                                             ('Ünï', '日本'), ('', 'Empty')]):
+            for extension in ['mp3', 'flac', 'm4a']:
+                fn = os.path.join(folder, '{}.{}'.format(i, extension))
+                if extension == 'mp3':
+                    benchmarks.write_mp3(fn, artist, title)
+                elif extension == 'flac':
+                    benchmarks.write_flac(fn, artist, title)
+                else:
+                    benchmarks.write_m4a(fn, artist, title)
+                songs.append(fn)
+        #Truncated in the ID3 header, in a frame header and in a frame
+        with open(songs[0], 'rb') as f:
+            data = f.read()
+        for size in [6, 15, 30]:
+            fn = os.path.join(folder, 'truncated{}.mp3'.format(size))
+            with open(fn, 'wb') as f:
+                f.write(data[:size])
+            with self.subTest(size=size):
+                self.assertIsNone(playlist_manipulator.read_header_metadata(fn))
+        #An MP4 file truncated inside its moov atom
+        with open(songs[2], 'rb') as f:
+            data = f.read()
+        fn = os.path.join(folder, 'truncated.m4a')
+        with open(fn, 'wb') as f:
+            f.write(data[:-20])
+        self.assertIsNone(playlist_manipulator.read_header_metadata(fn))
+        for root, _, fns in os.walk('tests/music'):
+            songs += [os.path.join(root, fn) for fn in fns]
+        fast = 0
+        for fn in songs:
+            meta = playlist_manipulator.read_header_metadata(fn)
+            playlist_manipulator.FAST_TAGS = False
+            try:
+                expected = playlist_manipulator.get_metadata(fn)
+            finally:
+                playlist_manipulator.FAST_TAGS = True
+            with self.subTest(fn=fn):
+                if meta is not None:
+                    fast += 1
+                    self.assertEqual(meta, expected)
+        self.assertGreater(fast, 0)
+
+    def test_natural_sorted(self):
+        names = ['Song 10.mp3', 'song 2.mp3', 'Song 1.mp3', 'Song2.mp3',
+                 'b.flac', 'A.mp3', 'a.mp3']
+        for i in range(3):
+            random.Random(i).shuffle(names)
+            with self.subTest(i=i):
+                self.assertEqual(playlist_manipulator.natural_sorted(names),
+                                 ['A.mp3', 'a.mp3', 'b.flac', 'Song2.mp3',
+                                  'Song 1.mp3', 'song 2.mp3', 'Song 10.mp3'])
+        
+        #Digits that are not ASCII are sorted as text
+        self.assertEqual(playlist_manipulator.natural_sorted(
+                            ['٣', '10', '²', '2', 'a²', 'a3', '3²']),
+                         ['2', '3²', '10', 'a3', 'a²', '²', '٣'])
+        folder = os.path.join('tests','natural_results')
+        for name in ['٣', '²', '3']:
+            os.makedirs(os.path.join(folder, name))
+        self.addCleanup(rmtree, folder)
+        self.assertEqual(list(playlist_manipulator.iter_all_files(folder)),
+                         ['?#EXTGRP:3', '?#EXTGRP:²', '?#EXTGRP:٣'])
+    
+    def test_mapped_playlist(self):
+        #Groups written from the mapped file are the same as parsed ones
+        fragments = ['#EXTM3U\n', '#EXTM3U extra\n', '#EXTGRP:Group\n',
+                     '#EXTGRP:Другая\r\n', '#EXTINF:1,Song\n', 'Song.mp3\n',
+                     'Song 2.mp3\r', '#Comment\n', '\n']
+        rng = random.Random(0)
+        fn = self.testfilenames[5]
+        for i in range(50):
+            lines = rng.choices(fragments, k = rng.randint(0, 12))
+            if i%2 == 0:
+                lines = [line.replace('\r','') for line in lines]
+            if i%3 == 0:
+                lines.append('Last.mp3')
+            open(fn,'wb').write(''.join(lines).encode('utf-8'))
+            groups = list(playlist_manipulator.iter_groups(
+                            open(fn,'r',encoding='utf-8')))
+            with self.subTest(i=i), \
+                    playlist_manipulator.MappedPlaylist(fn) as playlist:
+                self.assertEqual(len(playlist), len(groups))
+                for j, group in enumerate(groups):
+                    self.assertEqual(playlist.name(j), group.name)
+                    self.assertEqual(playlist.is_empty(j), group.is_empty())
+                    for header in [True, False]:
+                        f = io.BytesIO()
+                        playlist.write_group(f, j, header)
+                        self.assertEqual(f.getvalue(),
+                                         ''.join(group.lines(header))
+                                         .replace('\n', os.linesep)
+                                         .encode('utf-8'))
+    
+    def test_splice_file(self):
+        fn = self.testfilenames[5]
+        rng = random.Random(0)
+        for i in range(30):
+            data = bytes(rng.randrange(256) for _ in range(rng.randint(0,40)))
+            start = rng.randint(0, len(data))
+            end = rng.randint(start, len(data))
+            new = bytes(rng.randrange(256) for _ in range(rng.randint(0,20)))
+            open(fn,'wb').write(data)
+            playlist_manipulator.splice_file(fn, start, end, new,
+                                             buffer_size = 3)
+            with self.subTest(i=i):
+                self.assertEqual(open(fn,'rb').read(),
+                                 data[:start] + new + data[end:])
+    
+    def test_playlist_model(self):
+        lines = ['#EXTINF:1,A\n', 'a.mp3\n', '#EXTGRP:Rock\n',
+                 '#EXTINF:2,B\n', '#EXTVLCOPT:x\n', 'Song 2.mp3\n',
+                 'Song 10.mp3\n', '# trailing comment\n', '\n',
+                 '#EXTGRP:Empty\n', '#EXTM3U\n', '# only a trailer\n']
+        groups = list(playlist_manipulator.iter_groups(lines))
+        self.assertEqual([group.name for group in groups],
+                         [None, 'Rock', 'Empty', None])
+        rock = groups[1]
+        self.assertEqual([entry.path for entry in rock.entries],
+                         ['Song 2.mp3\n', 'Song 10.mp3\n'])
+        self.assertEqual(rock.entries[0].info, '#EXTINF:2,B\n#EXTVLCOPT:x\n')
+        self.assertEqual(rock.entries[1].info, '')
+        self.assertEqual(rock.trailer, '# trailing comment\n\n')
+        self.assertEqual([group.is_empty() for group in groups],
+                         [False, False, True, False])
+        
+        #The lines are written back unchanged, after the file header
+        playlist = playlist_manipulator.Playlist(groups)
+        self.assertEqual(''.join(playlist.lines()), ''.join(['#EXTM3U\n'] + lines))
+        playlist.remove_empty_groups()
+        self.assertEqual([group.name for group in playlist.groups],
+                         [None, 'Rock', None])
+        
+        #Songs go after the entries with an equal key and keep their order,
+        #before the trailer
+        Entry = playlist_manipulator.Entry
+        rock.insert([('Song 3.mp3', Entry('Three.mp3\n', '#EXTINF:3,C\n')),
+                     ('Song 1.mp3', Entry('One.mp3\n'))])
+        self.assertEqual(''.join(rock.lines(header = False)),
+                         'One.mp3\n#EXTINF:2,B\n#EXTVLCOPT:x\nSong 2.mp3\n'
+                         '#EXTINF:3,C\nThree.mp3\nSong 10.mp3\n'
+                         '# trailing comment\n\n')
+        group = playlist_manipulator.Group(
+            'Pop', [Entry('a/Song 2.mp3'), Entry('a/Song 10.mp3')], '#t\n')
+        group.insert([('song 2.mp3', Entry('First.mp3')),
+                      ('Song 99.mp3', Entry('Last.mp3')),
+                      ('SONG 2.mp3', Entry('Second.mp3'))])
+        self.assertEqual([entry.path for entry in group.entries],
+                         ['a/Song 2.mp3', 'First.mp3', 'Second.mp3',
+                          'a/Song 10.mp3', 'Last.mp3'])
+        self.assertEqual(list(group.lines(header = True))[-1], '#t\n')
+    
+    def test_group_insert(self):
+        #Reference: the songs inserted one by one
+        def insert_one_by_one(group, songs):
+            group = list(group)
+            for name, lines in songs:
+                for i,v in enumerate(group):
+                    if v[:4] != '#EXT' and \
+                    playlist_manipulator.str_smaller_win(name,v):
+                        break
+                else:
+                    i = len(group) + 1
+                group[i-1:i-1] = lines
+            return group
+        
+        rng = random.Random(0)
+        names = ['Song{}.mp3'.format(rng.randint(0,30)) for _ in range(200)]
+        for i in range(50):
+            group_names = rng.sample(names, rng.randint(1,20))
+            #Sorted groups as well as unsorted ones
+            if i%2 == 0:
+                group_names.sort(key=playlist_manipulator.natural_key)
+            group = []
+            for name in group_names:
+                group += ['#EXTINF:0,{}\n'.format(name), name+'\n']
+            songs = [(name, ['#EXTINF:1,{}\n'.format(name), name+'\n'])
+                     for name in rng.sample(names, rng.randint(0,20))]
+            #Without a header, the lines form a single group
+            parsed, = playlist_manipulator.iter_groups(group)
+            parsed.insert((name, playlist_manipulator.Entry(
+                                    lines[-1], ''.join(lines[:-1])))
+                          for name, lines in songs)
+            with self.subTest(i=i):
+                self.assertEqual(''.join(parsed.lines(header = False)),
+                                 ''.join(insert_one_by_one(group, songs)))
+    
     def setUp(self):
         args = type('', (), {})()
         self.args = args
@@ -118,8 +1118,9 @@ class PlaylistTestCase(unittest.TestCase):
         #delete created playlists
         # return
         for fn in self.testfilenames:
-            if os.path.exists(fn):
-                os.remove(fn)
+            for fn in [fn, playlist_manipulator.default_cache_fn(fn)]:
+                if os.path.exists(fn):
+                    os.remove(fn)
                 
         for fn in self.testfolders:
             if os.path.exists(fn):